@@ -0,0 +1,327 @@
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from math import ceil
+from os import getenv
+from time import monotonic
+
+import metrics
+from encoder import TOOL_RESULT_TOKEN_BUDGET
+from templates import response_template, system_prompt
+from tools import TOOLS
+
+# The provider quota, shared by all api processes. 0 turns a limit off.
+LLM_REQUESTS_PER_MINUTE = float(getenv("LLM_REQUESTS_PER_MINUTE", "30"))
+LLM_TOKENS_PER_MINUTE = float(getenv("LLM_TOKENS_PER_MINUTE", "6000"))
+# Each process enforces its share of the quota and of every user's rate.
+# gunicorn.conf.py sets it to the worker count; the ASGI app is one process.
+ADMISSION_WORKERS = max(1, int(getenv("ADMISSION_WORKERS", "1")))
+
+
+def prompt_token_estimate():
+    # A tool call sends the system prompt (which embeds the tool schema) and
+    # the schema again as tools; the final call sends the response template.
+    # Both carry up to a budget of tool results. About 4 characters a token.
+    schema = json.dumps(TOOLS)
+    tool_call = len(system_prompt.format(tools_json=schema)) + len(schema)
+    return (tool_call + len(response_template)) // 4 + 2 * TOOL_RESULT_TOKEN_BUDGET
+
+
+# Reserved for every prompt that reaches the model and settled against what
+# the provider reports once the answer is done.
+ADMISSION_PROMPT_CALLS = int(getenv("ADMISSION_PROMPT_CALLS", "2"))
+ADMISSION_PROMPT_TOKENS = int(
+    getenv("ADMISSION_PROMPT_TOKENS") or prompt_token_estimate()
+)
+ADMISSION_USER_RATE = float(getenv("ADMISSION_USER_RATE", "10"))
+ADMISSION_USER_BURST = float(getenv("ADMISSION_USER_BURST", "5"))
+ADMISSION_QUEUE_SIZE = int(getenv("ADMISSION_QUEUE_SIZE", "100"))
+ADMISSION_MAX_WAIT = float(getenv("ADMISSION_MAX_WAIT", "60"))
+USER_BUCKETS_MAX = 10000
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason}, retry after {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = max(1, ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        if self.unlimited:
+            return 0.0
+        self.refill(now)
+        # A request larger than the bucket only needs a full one.
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        # May go negative when a prompt used more than was reserved; the
+        # debt delays the next admissions. Negative amounts refund.
+        if not self.unlimited:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class Waiter:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.granted = False
+        self.event = threading.Event()
+
+    def notify(self):
+        self.event.set()
+
+
+class AsyncWaiter(Waiter):
+    def __init__(self, user_id):
+        super().__init__(user_id)
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Admission:
+    def __init__(self):
+        requests = LLM_REQUESTS_PER_MINUTE / ADMISSION_WORKERS
+        tokens = LLM_TOKENS_PER_MINUTE / ADMISSION_WORKERS
+        self.requests = TokenBucket(requests, requests)
+        self.tokens = TokenBucket(tokens, tokens)
+        self.users = {}
+        # user_id -> deque of waiters; users are served round-robin so one
+        # busy user cannot hold the whole queue.
+        self.queue = OrderedDict()
+        self.queued = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pid = None
+        self.stats = {
+            "admitted": 0,
+            "waited": 0,
+            "rejected_user": 0,
+            "rejected_queue": 0,
+            "rejected_timeout": 0,
+            "provider_limited": 0,
+        }
+
+    def user_bucket(self, user_id):
+        bucket = self.users.get(user_id)
+        if bucket is None:
+            if len(self.users) >= USER_BUCKETS_MAX:
+                now = monotonic()
+                for key, other in list(self.users.items()):
+                    other.refill(now)
+                    if other.tokens >= other.capacity:
+                        del self.users[key]
+            bucket = self.users[user_id] = TokenBucket(
+                ADMISSION_USER_RATE / ADMISSION_WORKERS,
+                max(1.0, ADMISSION_USER_BURST / ADMISSION_WORKERS),
+            )
+        return bucket
+
+    def global_wait(self, now):
+        return max(
+            self.requests.wait_time(ADMISSION_PROMPT_CALLS, now),
+            self.tokens.wait_time(ADMISSION_PROMPT_TOKENS, now),
+        )
+
+    def reserve(self):
+        self.requests.take(ADMISSION_PROMPT_CALLS)
+        self.tokens.take(ADMISSION_PROMPT_TOKENS)
+        self.stats["admitted"] += 1
+
+    def enter(self, waiter):
+        # Returns True when the caller may go ahead right away, False when
+        # it was queued and must wait for waiter to be notified.
+        now = monotonic()
+        with self.condition:
+            bucket = self.user_bucket(waiter.user_id)
+            user_wait = bucket.wait_time(1, now)
+            if user_wait > 0:
+                self.stats["rejected_user"] += 1
+                raise Overloaded("too many prompts from this user", user_wait)
+            if not self.queued and self.global_wait(now) == 0:
+                bucket.take(1)
+                self.reserve()
+                return True
+            if self.queued >= ADMISSION_QUEUE_SIZE:
+                self.stats["rejected_queue"] += 1
+                raise Overloaded("admission queue is full", self.drain_estimate(now))
+            bucket.take(1)
+            self.queue.setdefault(waiter.user_id, deque()).append(waiter)
+            self.queued += 1
+            self.stats["waited"] += 1
+            self._ensure_started()
+            self.condition.notify()
+            return False
+
+    def abandon(self, waiter):
+        # Called when a waiter gives up; True if it was granted meanwhile
+        # and may still go ahead.
+        with self.condition:
+            if waiter.granted:
+                return True
+            waiters = self.queue.get(waiter.user_id)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                self.queued -= 1
+                if not waiters:
+                    del self.queue[waiter.user_id]
+            self.stats["rejected_timeout"] += 1
+            return False
+
+    def drain_estimate(self, now):
+        with self.condition:
+            return self.global_wait(now) + self.queued * self.prompt_interval()
+
+    def prompt_interval(self):
+        return max(
+            (
+                ADMISSION_PROMPT_CALLS / self.requests.rate
+                if not self.requests.unlimited
+                else 0.0
+            ),
+            (
+                ADMISSION_PROMPT_TOKENS / self.tokens.rate
+                if not self.tokens.unlimited
+                else 0.0
+            ),
+        )
+
+    def settle(self, calls, tokens):
+        with self.condition:
+            self.requests.take(calls - ADMISSION_PROMPT_CALLS)
+            self.tokens.take(tokens - ADMISSION_PROMPT_TOKENS)
+            self.condition.notify()
+
+    def provider_limited(self, retry_after):
+        # The provider said no despite our budget: empty the buckets so the
+        # queue waits as long as it asked.
+        with self.condition:
+            self.stats["provider_limited"] += 1
+            for bucket in (self.requests, self.tokens):
+                if not bucket.unlimited:
+                    bucket.refill(monotonic())
+                    bucket.tokens = min(bucket.tokens, -retry_after * bucket.rate)
+
+    def _dispatch(self, now):
+        while self.queue:
+            wait = self.global_wait(now)
+            if wait > 0:
+                return wait
+            user_id, waiters = self.queue.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                self.queue[user_id] = waiters
+            self.queued -= 1
+            self.reserve()
+            waiter.granted = True
+            waiter.notify()
+        return None
+
+    def _run(self):
+        with self.condition:
+            while True:
+                self.condition.wait(self._dispatch(monotonic()))
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, see logwriter.
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name="admission", daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        with self.condition:
+            result = dict(self.stats)
+            result["queued"] = self.queued
+            result["queued_users"] = len(self.queue)
+        return result
+
+
+admission = Admission()
+metrics.register_stats("ponyfin_admission", admission.snapshot)
+
+
+def provider_overload(error):
+    # Groq (and other OpenAI-style clients) raise errors carrying the HTTP
+    # status; a 429 becomes an Overloaded with the provider's retry hint.
+    if getattr(error, "status_code", None) != 429:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after", 10))
+    except ValueError:
+        retry_after = 10.0
+    admission.provider_limited(retry_after)
+    return Overloaded("model provider rate limit", retry_after)
+
+
+@contextmanager
+def admit(ctx):
+    started = monotonic()
+    waiter = Waiter(ctx.user_id)
+    if not admission.enter(waiter):
+        if not waiter.event.wait(ADMISSION_MAX_WAIT) and not admission.abandon(waiter):
+            raise Overloaded(
+                "waited too long for the model", admission.drain_estimate(monotonic())
+            )
+    metrics.ADMISSION_WAIT_SECONDS.observe(monotonic() - started)
+    try:
+        yield
+    except Exception as e:
+        overload = provider_overload(e)
+        if overload is None:
+            raise
+        raise overload from e
+    finally:
+        admission.settle(ctx.llm_calls, ctx.tokens)
+
+
+@asynccontextmanager
+async def aadmit(ctx):
+    started = monotonic()
+    waiter = AsyncWaiter(ctx.user_id)
+    if not admission.enter(waiter):
+        try:
+            await asyncio.wait_for(waiter.future, ADMISSION_MAX_WAIT)
+        except asyncio.TimeoutError:
+            if not admission.abandon(waiter):
+                raise Overloaded(
+                    "waited too long for the model",
+                    admission.drain_estimate(monotonic()),
+                )
+    metrics.ADMISSION_WAIT_SECONDS.observe(monotonic() - started)
+    try:
+        yield
+    except Exception as e:
+        overload = provider_overload(e)
+        if overload is None:
+            raise
+        raise overload from e
+    finally:
+        admission.settle(ctx.llm_calls, ctx.tokens)
@@ -0,0 +1,88 @@
+from time import monotonic
+
+import db
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+_pool = None
+_next_update_cleanup = 0.0
+
+
+def get_conninfo():
+    params = db.connection_params()
+    params["dbname"] = params.pop("database")
+    return make_conninfo(**params)
+
+
+async def open_pool():
+    global _pool
+    if _pool is None:
+        _pool = AsyncConnectionPool(
+            get_conninfo(),
+            min_size=db.DB_POOL_MIN,
+            max_size=db.DB_POOL_MAX,
+            timeout=db.DB_POOL_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            open=False,
+        )
+        await _pool.open()
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def pool_stats():
+    return _pool.get_stats() if _pool is not None else {}
+
+
+async def get_user_registered(user_id):
+    sql_string = "SELECT id, data_version FROM users WHERE telegram_id = %s"
+
+    pool = await open_pool()
+    async with pool.connection() as conn:
+        cursor = await conn.execute(sql_string, (user_id,))
+        return await cursor.fetchone()
+
+
+async def insert_user(payload):
+    sql_string = "INSERT INTO users (telegram_id, name) VALUES (%s, %s) RETURNING id, registration_date"
+
+    pool = await open_pool()
+    async with pool.connection() as conn:
+        cursor = await conn.execute(
+            sql_string, (payload["telegram_id"], payload["name"])
+        )
+        row = await cursor.fetchone()
+
+    return [row[0], row[1]]
+
+
+async def claim_update(update_id):
+    global _next_update_cleanup
+    sql_string = "INSERT INTO telegram_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING update_id"
+
+    pool = await open_pool()
+    async with pool.connection() as conn:
+        cursor = await conn.execute(sql_string, (update_id,))
+        claimed = await cursor.fetchone() is not None
+        if monotonic() >= _next_update_cleanup:
+            _next_update_cleanup = monotonic() + db.UPDATE_CLEANUP_INTERVAL
+            await conn.execute(
+                "DELETE FROM telegram_updates WHERE received_at < now() - %s * interval '1 hour'",
+                (db.UPDATE_RETENTION_HOURS,),
+            )
+
+    return claimed
+
+
+async def release_update(update_id):
+    sql_string = "DELETE FROM telegram_updates WHERE update_id = %s"
+
+    pool = await open_pool()
+    async with pool.connection() as conn:
+        await conn.execute(sql_string, (update_id,))
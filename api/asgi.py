@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from os import getenv
+
+import aiodb
+import jobs
+import metrics
+import warmup
+from admission import Overloaded
+from chains import amake_response, astream_response
+from migrate import migrate
+from quart import Quart, request
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+app = Quart(__name__)
+
+
+@app.before_serving
+async def startup():
+    await asyncio.to_thread(migrate)
+    await aiodb.open_pool()
+    await asyncio.to_thread(warmup.warmup)
+
+
+@app.after_serving
+async def shutdown():
+    await asyncio.to_thread(warmup.shutdown)
+    await aiodb.close_pool()
+
+
+@app.errorhandler(Overloaded)
+async def overloaded(error):
+    return (
+        {"message": error.reason, "retry_after": error.retry_after},
+        429,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+async def prepend(first, chunks):
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+@app.route("/users", methods=["POST"])
+async def post_user():
+    data = await request.get_json()
+    if await aiodb.get_user_registered(data["telegram_id"]):
+        return {"message": "already registered"}, 409
+    if "telegram_id" in data and "name" in data:
+        await aiodb.insert_user(data)
+    else:
+        return {"message": "Invalid data"}, 400
+    return {"message": "success"}, 201
+
+
+@app.route("/prompt", methods=["POST"])
+async def prompt():
+    data = await request.get_json()
+    user_id = await aiodb.get_user_registered(data["user_id"])
+    if user_id and data.get("stream"):
+        chunks = astream_response(
+            user_id=user_id[0],
+            question=data["prompt"],
+            data_version=user_id[1],
+            message_id=data.get("message_id"),
+        )
+        first = await anext(chunks, "")
+        return (
+            prepend(first, chunks),
+            200,
+            {"Content-Type": "text/plain; charset=utf-8"},
+        )
+    if user_id:
+        return await amake_response(
+            user_id=user_id[0],
+            question=data["prompt"],
+            data_version=user_id[1],
+            message_id=data.get("message_id"),
+        )
+    return {"message": "Not registered"}, 401
+
+
+@app.route("/jobs", methods=["POST"])
+async def post_job():
+    data = await request.get_json()
+    user_id = await aiodb.get_user_registered(data["user_id"])
+    if not user_id:
+        return {"message": "Not registered"}, 401
+    if data.get("callback_url") and not jobs.callback_allowed(data["callback_url"]):
+        return {"message": "callback_url is not allowed"}, 400
+    job, created = await asyncio.to_thread(
+        jobs.submit,
+        user_id=user_id[0],
+        chat_id=data.get("chat_id", data["user_id"]),
+        prompt=data["prompt"],
+        message_id=data.get("message_id"),
+        callback_url=data.get("callback_url"),
+    )
+    return job, 202 if created else 200
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+async def get_job(job_id):
+    wait = min(request.args.get("wait", 0, type=float), jobs.JOB_MAX_WAIT)
+    deadline = asyncio.get_running_loop().time() + wait
+    while True:
+        job = await asyncio.to_thread(jobs.get_job, job_id)
+        if job is None:
+            return {"message": "Not found"}, 404
+        remaining = deadline - asyncio.get_running_loop().time()
+        if job["status"] in jobs.FINISHED or remaining <= 0:
+            return job
+        await asyncio.sleep(min(remaining, jobs.JOB_POLL_INTERVAL))
+
+
+@app.route("/updates/<int:update_id>", methods=["POST"])
+async def claim_update(update_id):
+    if not await aiodb.claim_update(update_id):
+        return {"message": "already received"}, 409
+    return {"message": "success"}, 201
+
+
+@app.route("/updates/<int:update_id>", methods=["DELETE"])
+async def release_update(update_id):
+    await aiodb.release_update(update_id)
+    return {"message": "success"}
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+@app.route("/health", methods=["GET"])
+async def health():
+    if not warmup.ready.is_set():
+        return {"status": "starting"}, 503
+    return {"status": "ok"}
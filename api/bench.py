@@ -0,0 +1,462 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import cache
+
+import psycopg2
+from db import connection, connection_params
+from explain import fill
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from percentiles import percentile
+
+# Seeded users get telegram ids from here up, so a benchmark never touches
+# real accounts; users registered during a run are numbered after them.
+BENCH_TELEGRAM_ID = 9_000_000_000
+CATEGORIES = ["Їжа", "Транспорт", "Кава", "Житло", "Розваги", "Здоров'я", "Одяг"]
+INCOME_SOURCES = ["salary", "freelance", "gift"]
+
+# Questions the fake model understands and the tool calls it answers with.
+# They cover reads the template renderer answers, parallel reads, a write,
+# a result the model summarizes and an answer without tools. "кава 85" is
+# recorded by the fast path and never reaches the model.
+SCRIPTS = {
+    "Скільки я витратив цього місяця?": [
+        ("summarize_expenses", {"start_date": "{month_start}", "end_date": "{now}"})
+    ],
+    "Покажи останні витрати": [("get_expenses", {"sort_by": "date", "limit": 20})],
+    "Які в мене доходи цього місяця?": [
+        ("get_incomes", {"start_date": "{month_start}"})
+    ],
+    "Мої бюджети на цей місяць": [
+        ("get_budgets", {"month": "{month}", "year": "{year}"})
+    ],
+    "Чи вкладаюся я в бюджет?": [
+        ("check_budget", {"month": "{month}", "year": "{year}"})
+    ],
+    "Порівняй витрати і доходи за місяць": [
+        ("summarize_expenses", {"start_date": "{month_start}", "end_date": "{now}"}),
+        ("summarize_incomes", {"start_date": "{month_start}", "end_date": "{now}"}),
+    ],
+    "Знайди витрати в гривнях": [
+        ("query_data", {"table": "expenses", "filters": {"currency": "UAH"}})
+    ],
+    "Отримав зарплату 30000": [
+        (
+            "add_income",
+            {"amount": 30000, "currency": "UAH", "date": "{now}", "source": "salary"},
+        )
+    ],
+    "Привіт": [],
+    "кава 85": [],
+}
+QUESTIONS = list(SCRIPTS)
+
+
+def script_values():
+    now = datetime.now()
+    return {
+        "now": now.isoformat(),
+        "month_start": now.replace(day=1, hour=0, minute=0, second=0).isoformat(),
+        "month": now.month,
+        "year": now.year,
+    }
+
+
+class ScriptedChatModel(BaseChatModel):
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def _reply(self, messages, tools):
+        prompt = messages[-1].content
+        if tools:
+            # "Current time: ...\n{question}\nPrevious tool results: ..."
+            question = prompt.split("\n")[1]
+            calls = SCRIPTS.get(question, [])
+            message = AIMessage(
+                content="" if calls else "Привіт! Чим можу допомогти?",
+                tool_calls=[
+                    {
+                        "name": name,
+                        "args": fill(args, script_values()),
+                        "id": f"call_{i}",
+                    }
+                    for i, (name, args) in enumerate(calls)
+                ],
+            )
+        else:
+            message = AIMessage(content="Ось короткий підсумок за вашими даними.")
+        message.usage_metadata = {
+            "input_tokens": sum(len(m.content) for m in messages) // 4,
+            "output_tokens": len(str(message.content)) // 4
+            + 10 * len(message.tool_calls),
+            "total_tokens": 0,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return self._reply(messages, kwargs.get("tools"))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._reply(messages, kwargs.get("tools"))
+
+
+def install_fake_llm():
+    import chains
+
+    latency = float(os.environ.get("BENCH_LLM_LATENCY", "0.5"))
+    chains.get_llm = cache(lambda: ScriptedChatModel(latency=latency))
+    chains.get_tool_chain.cache_clear()
+    chains.get_final_chain.cache_clear()
+
+
+def __getattr__(name):
+    # gunicorn bench:app / hypercorn bench:asgi_app serve the real apps with
+    # the scripted model in place of Groq.
+    if name == "app":
+        install_fake_llm()
+        from main import app
+
+        return app
+    if name == "asgi_app":
+        install_fake_llm()
+        from asgi import app
+
+        return app
+    raise AttributeError(name)
+
+
+def bench_user_ids(cursor, users):
+    cursor.execute(
+        "SELECT id FROM users WHERE telegram_id BETWEEN %s AND %s ORDER BY id",
+        (BENCH_TELEGRAM_ID + 1, BENCH_TELEGRAM_ID + users),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def seed(options):
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            if options.reseed:
+                cursor.execute(
+                    "DELETE FROM users WHERE telegram_id > %s", (BENCH_TELEGRAM_ID,)
+                )
+            elif len(bench_user_ids(cursor, options.users)) == options.users:
+                return
+            cursor.execute("SELECT setseed(%s)", (options.seed / 2**31,))
+            cursor.execute(
+                """
+                INSERT INTO users (telegram_id, name)
+                SELECT %s + g, 'bench ' || g FROM generate_series(1, %s) g
+                ON CONFLICT (telegram_id) DO NOTHING
+                """,
+                (BENCH_TELEGRAM_ID, options.users),
+            )
+            user_ids = bench_user_ids(cursor, options.users)
+            cursor.execute(
+                "DELETE FROM categories WHERE user_id = ANY(%s)", (user_ids,)
+            )
+            cursor.execute(
+                """
+                INSERT INTO categories (name, user_id)
+                SELECT name, user_id FROM unnest(%s::bigint[]) user_id
+                CROSS JOIN unnest(%s::text[]) name
+                """,
+                (user_ids, CATEGORIES),
+            )
+            cursor.execute(
+                """
+                INSERT INTO expenses (amount, currency, date, description, user_id, category_id)
+                SELECT 10 + (random() * 2000)::bigint, 'UAH',
+                       now() - random() * interval '365 days', 'bench', c.user_id, c.id
+                FROM (
+                  SELECT id, user_id,
+                         row_number() OVER (PARTITION BY user_id ORDER BY id) - 1 AS n
+                  FROM categories WHERE user_id = ANY(%s)
+                ) c
+                JOIN generate_series(1, %s) g ON g %% %s = c.n
+                """,
+                (user_ids, options.expenses, len(CATEGORIES)),
+            )
+            cursor.execute(
+                """
+                INSERT INTO incomes (amount, currency, date, source, user_id)
+                SELECT 1000 + (random() * 40000)::bigint, 'UAH',
+                       now() - random() * interval '365 days',
+                       (%s::text[])[1 + g %% %s], user_id
+                FROM unnest(%s::bigint[]) user_id
+                CROSS JOIN generate_series(1, %s) g
+                """,
+                (INCOME_SOURCES, len(INCOME_SOURCES), user_ids, options.incomes),
+            )
+            now = datetime.now()
+            cursor.execute(
+                """
+                INSERT INTO budgets (amount, currency, month, year, user_id)
+                SELECT 40000, 'UAH', %s, %s, user_id FROM unnest(%s::bigint[]) user_id
+                """,
+                (now.month, now.year, user_ids),
+            )
+            cursor.execute("ANALYZE")
+        conn.commit()
+    print(
+        f"Seeded {options.users} users with {options.expenses} expenses and "
+        f"{options.incomes} incomes each",
+        flush=True,
+    )
+
+
+def last_telegram_id(options):
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT MAX(telegram_id) FROM users WHERE telegram_id > %s",
+                (BENCH_TELEGRAM_ID,),
+            )
+            row = cursor.fetchone()
+    return max(row[0] or 0, BENCH_TELEGRAM_ID + options.users)
+
+
+class ConnectionSampler(threading.Thread):
+    def __init__(self, interval=0.2):
+        super().__init__(name="connection-sampler", daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.done = threading.Event()
+
+    def run(self):
+        conn = psycopg2.connect(**connection_params())
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                while not self.done.is_set():
+                    cursor.execute("""
+                        SELECT count(*), count(*) FILTER (WHERE state = 'active')
+                        FROM pg_stat_activity
+                        WHERE datname = current_database() AND pid <> pg_backend_pid()
+                        """)
+                    self.samples.append(cursor.fetchone())
+                    self.done.wait(self.interval)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return {
+            "max": max((total for total, _ in self.samples), default=0),
+            "max_active": max((active for _, active in self.samples), default=0),
+            "avg": (
+                sum(total for total, _ in self.samples) / len(self.samples)
+                if self.samples
+                else 0
+            ),
+        }
+
+
+def start_server(options):
+    url = f"http://127.0.0.1:{options.port}"
+    env = dict(os.environ, BENCH_LLM_LATENCY=str(options.llm_latency))
+    # The scripted model has no quota; with admission on, a run would mostly
+    # measure prompts queueing for the Groq budget.
+    env.update(LLM_REQUESTS_PER_MINUTE="0", LLM_TOKENS_PER_MINUTE="0")
+    env["ADMISSION_USER_RATE"] = "0"
+    if options.no_cache:
+        env["RESPONSE_CACHE_SIZE"] = "0"
+    if options.workers:
+        command = [
+            "gunicorn",
+            "bench:app",
+            "-w",
+            str(options.workers),
+            "--threads",
+            str(options.threads),
+            "-b",
+            f"127.0.0.1:{options.port}",
+            "--timeout",
+            "180",
+        ]
+        server = subprocess.Popen(command, env=env)
+        stop = server.terminate
+    else:
+        # In-process threaded werkzeug server; the environment has to be set
+        # before the app modules read it.
+        os.environ.update(env)
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+        server = make_server(
+            "127.0.0.1", options.port, __getattr__("app"), threaded=True
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stop = server.shutdown
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{url}/metrics", timeout=1).close()
+            return url, stop
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    stop()
+    raise SystemExit(f"api did not start on {url}")
+
+
+def post(url, path, payload):
+    request = urllib.request.Request(
+        url + path,
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=180) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        status = 0
+    return status, time.perf_counter() - started
+
+
+def run_load(url, options):
+    rng = random.Random(options.seed)
+    plan = []
+    registered = last_telegram_id(options)
+    for _ in range(options.requests):
+        if rng.random() < options.register_ratio:
+            registered += 1
+            plan.append(("/users", {"telegram_id": registered, "name": "bench"}))
+        else:
+            plan.append(
+                (
+                    "/prompt",
+                    {
+                        "user_id": BENCH_TELEGRAM_ID + rng.randint(1, options.users),
+                        "prompt": rng.choice(QUESTIONS),
+                    },
+                )
+            )
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        results = list(executor.map(lambda item: (item[0], *post(url, *item)), plan))
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for path in sorted({path for path, _, _ in results}) + ["all"]:
+        rows = [row for row in results if path in ("all", row[0])]
+        latencies = sorted(latency for _, _, latency in rows)
+        statuses = {}
+        for _, status, _ in rows:
+            statuses[status] = statuses.get(status, 0) + 1
+        summary[path] = {
+            "requests": len(rows),
+            # 429 is admission turning the request away.
+            "errors": sum(
+                1 for _, status, _ in rows if status in (0, 429) or status >= 500
+            ),
+            "statuses": statuses,
+            "rps": len(rows) / elapsed if elapsed else 0.0,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+        }
+    return summary
+
+
+def print_report(summary, connections, elapsed):
+    print(
+        f"\n{'path':<10}{'reqs':>7}{'errors':>8}{'rps':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+    )
+    for path, row in summary.items():
+        print(
+            f"{path:<10}{row['requests']:>7}{row['errors']:>8}{row['rps']:>9.1f}"
+            f"{row['p50'] * 1000:>9.0f}{row['p95'] * 1000:>9.0f}"
+            f"{row['p99'] * 1000:>9.0f}{row['max'] * 1000:>9.0f}"
+        )
+    print(
+        f"\n{elapsed:.1f}s, db connections: max {connections['max']}, "
+        f"max active {connections['max_active']}, avg {connections['avg']:.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test the api with a scripted model and seeded Postgres."
+    )
+    parser.add_argument("--users", type=int, default=100, help="seeded users")
+    parser.add_argument("--expenses", type=int, default=2000, help="per user")
+    parser.add_argument("--incomes", type=int, default=100, help="per user")
+    parser.add_argument("--reseed", action="store_true", help="recreate bench users")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--register-ratio", type=float, default=0.05, help="share of /users calls"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.5, help="seconds per model call"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="disable answer cache")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="gunicorn workers, 0 serves in-process"
+    )
+    parser.add_argument("--threads", type=int, default=1, help="threads per worker")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    options = parser.parse_args()
+
+    seed(options)
+    url, stop = start_server(options)
+    sampler = ConnectionSampler()
+    sampler.start()
+    try:
+        results, elapsed = run_load(url, options)
+    finally:
+        connections = sampler.stop()
+        stop()
+
+    summary = summarize(results, elapsed)
+    print_report(summary, connections, elapsed)
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(
+                {
+                    "options": vars(options),
+                    "elapsed": elapsed,
+                    "paths": summary,
+                    "db_connections": connections,
+                },
+                file,
+                indent=2,
+            )
+    if summary["all"]["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import re
+from collections import OrderedDict
+from datetime import datetime
+from os import getenv
+from threading import Lock
+from time import monotonic
+
+import metrics
+from tools import ROLLUP_TZ
+
+RESPONSE_CACHE_SIZE = int(getenv("RESPONSE_CACHE_SIZE", "10000"))
+RESPONSE_CACHE_TTL = float(getenv("RESPONSE_CACHE_TTL", "600"))
+
+SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    return SPACES_RE.sub(" ", question.lower()).strip(" .!?,")
+
+
+class ResponseCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def key(self, user_id, data_version, question):
+        # "Today" and "this month" mean something else after local midnight.
+        today = datetime.now(ROLLUP_TZ).date()
+        return (user_id, data_version, today, normalize_question(question))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < monotonic():
+                del self.entries[key]
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, answer):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (answer, monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.stats)
+            result["size"] = len(self.entries)
+        return result
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+metrics.register_stats("ponyfin_response_cache", response_cache.snapshot)
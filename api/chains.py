@@ -1,18 +1,32 @@
+import asyncio
+import importlib
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import cache
 from os import getenv
+from time import perf_counter
 
+import fastpath
+import logwriter
+import metrics
 import pytz
-from db import log_tools
+import renderers
+from admission import aadmit, admit
+from cache import response_cache
+from context import RequestContext
 from dotenv import load_dotenv
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_groq import ChatGroq
+from encoder import encode_results
+from singleflight import prompt_flights
 from templates import response_template, system_prompt
-from tools import TOOLS_JSON, run_tool
+from tools import READ_ONLY_TOOLS, TOOLS, run_tool
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
 def get_current_timestamptz():
     kyiv_tz = pytz.timezone("Europe/Kyiv")
@@ -20,117 +34,415 @@ def get_current_timestamptz():
     return current_time.strftime("%Y-%m-%d %H:%M:%S%z")
 
 
-tools_called = []
-
+def cached_answer(ctx):
+    if ctx.data_version is None:
+        return None
+    return response_cache.get(
+        response_cache.key(ctx.user_id, ctx.data_version, ctx.question)
+    )
 
-def make_response(user_id, question):
-    response = run_full_chain(user_id, question)
 
-    log_tools(
-        user_id=user_id,
-        question=question,
-        tools_called=response["tools_called"],
-        tools_results=response["tools_results"],
-        response=response["answer"],
+def remember_answer(ctx):
+    # Only answers that changed nothing can be replayed; the data version in
+    # the key already rules out answers computed before a later write.
+    if ctx.data_version is None or not ctx.answer:
+        return
+    if any(call["name"] not in READ_ONLY_TOOLS for call in ctx.tool_calls):
+        return
+    response_cache.put(
+        response_cache.key(ctx.user_id, ctx.data_version, ctx.question), ctx.answer
     )
-    global tools_called
-    tools_called = []
-    return {"answer": response["answer"]}
 
 
-def run_full_chain(user_id, question):
-    llm = ChatGroq(
-        model=getenv("MODEL_NAME"),
-        temperature=0,
-    )
+def prepare_answer(ctx):
+    ctx.answer = cached_answer(ctx)
+    if ctx.answer is not None:
+        ctx.from_cache = True
+        ctx.path = "cache"
+        return True
+    if fastpath.try_handle(ctx):
+        ctx.path = "fastpath"
+        return True
+    return False
+
+
+def finish_response(ctx):
+    metrics.PROMPT_SECONDS.observe(ctx.timings.get("total", 0.0), ctx.path)
+    if ctx.path not in ("cache", "fastpath"):
+        metrics.LOOP_ITERATIONS.observe(ctx.iterations)
+    if not ctx.from_cache:
+        remember_answer(ctx)
+    logwriter.log_tools(ctx)
+
+
+def make_response(user_id, question, data_version=None, message_id=None):
+    # A duplicate of a prompt that is running or just finished waits for
+    # that answer instead of running the chain (and its writes) again.
+    ticket = prompt_flights.join(user_id, question, message_id)
+    if not ticket.leader:
+        answer = ticket.wait()
+        if answer is not None:
+            return {"answer": answer}
+
+    ctx = RequestContext(user_id=user_id, question=question, data_version=data_version)
+    try:
+        with ctx.timed("total"):
+            if not prepare_answer(ctx):
+                with admit(ctx):
+                    run_full_chain(ctx)
+    finally:
+        ticket.finish(ctx.answer)
+
+    finish_response(ctx)
+    return {"answer": ctx.answer}
 
-    prompt = ChatPromptTemplate.from_messages(
+
+async def amake_response(user_id, question, data_version=None, message_id=None):
+    ticket = await asyncio.to_thread(prompt_flights.join, user_id, question, message_id)
+    if not ticket.leader:
+        answer = await asyncio.to_thread(ticket.wait)
+        if answer is not None:
+            return {"answer": answer}
+
+    ctx = RequestContext(user_id=user_id, question=question, data_version=data_version)
+    try:
+        with ctx.timed("total"):
+            if not await asyncio.to_thread(prepare_answer, ctx):
+                async with aadmit(ctx):
+                    await arun_full_chain(ctx)
+    finally:
+        await asyncio.to_thread(ticket.finish, ctx.answer)
+
+    finish_response(ctx)
+    return {"answer": ctx.answer}
+
+
+# langchain and the Groq client take most of the api's import time, so
+# they are imported on first use and /users never waits for them.
+LLM_MODULES = (
+    "langchain_core.callbacks",
+    "langchain_core.output_parsers",
+    "langchain_core.prompts",
+    "langchain_groq",
+)
+
+
+def import_llm_stack():
+    for name in LLM_MODULES:
+        importlib.import_module(name)
+
+
+# The system messages below carry no per-request data, so the prompt prefix
+# is byte-identical between requests and provider-side prompt caching can
+# apply. Only the current time, the question and tool results vary, and
+# they live in the human message.
+@cache
+def get_tool_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(
         [
             (
                 "system",
-                system_prompt.format(
-                    tools_json=json.dumps(TOOLS_JSON),
-                    current_time=get_current_timestamptz(),
-                )
+                system_prompt.format(tools_json=json.dumps(TOOLS))
                 .replace("{", "{{")
                 .replace("}", "}}"),
             ),
-            ("human", "{question}\nPrevious tool results: {tool_results}"),
+            (
+                "human",
+                "Current time: {current_time}\n{question}\nPrevious tool results: {tool_results}",
+            ),
         ]
     )
 
-    def execute_tool(vars):
-        tool_results = []
-        if isinstance(vars, dict):
-            tool_calls = vars.get("tool_calls", [])
-        else:
-            tool_calls = getattr(vars, "tool_calls", [])
-
-        if tool_calls:
-            for tool_call in tool_calls:
-                global tools_called
-                args = (
-                    tool_call["args"]
-                    if isinstance(tool_call, dict)
-                    else json.loads(tool_call.args)
-                )
-                tool_name = (
-                    tool_call["name"] if isinstance(tool_call, dict) else tool_call.name
-                )
-                tools_called.append(f"Tool called: {tool_name} with arguments: {args}")
-                print(f"{user_id}; {tool_name}; {args}", flush=True)
-                result = run_tool(user_id, tool_name, args)
-                print(result, flush=True)
-                tool_results.append({"tool": tool_name, "result": result})
-                print(tool_results, flush=True)
-            return {
-                "tool_results": tool_results,
-                "tool_calls": [],
-            }
-        return {
-            "tool_results": tool_results,
-            "tool_calls": [],
-        }
-
-    chain = (
-        prompt
-        | llm.bind(tools=json.loads(TOOLS_JSON), tool_choice="auto")
-        | execute_tool
-    )
 
-    max_iterations = 5
-    state = {"question": question, "tool_results": []}
-    for _ in range(max_iterations):
-        result = chain.invoke(state)
-        state["tool_results"] = result["tool_results"]
-        if not result.get("tool_calls"):
-            break
+@cache
+def get_final_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
 
-    final_prompt = ChatPromptTemplate.from_messages(
+    return ChatPromptTemplate.from_messages(
         [
-            (
-                "system",
-                response_template.format(
-                    results=json.dumps(state["tool_results"])
-                    .replace("{", "{{")
-                    .replace("}", "}}"),
-                ),
-            ),
+            ("system", response_template),
             ("human", "{question}\nTool results: {tool_results}"),
         ]
     )
-    final_chain = final_prompt | llm | StrOutputParser()
-    final_answer = final_chain.invoke(
-        {
-            "question": question,
-            "tool_results": json.dumps(state["tool_results"])
-            .replace("{", "{{")
-            .replace("}", "}}"),
-        }
+
+
+@cache
+def token_counter_class():
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TokenCounter(BaseCallbackHandler):
+        run_inline = True
+
+        def __init__(self, ctx):
+            self.ctx = ctx
+
+        def on_llm_end(self, response, **kwargs):
+            for generations in response.generations:
+                for generation in generations:
+                    usage = getattr(
+                        getattr(generation, "message", None), "usage_metadata", None
+                    )
+                    if usage:
+                        metrics.LLM_TOKENS.inc("prompt", amount=usage["input_tokens"])
+                        metrics.LLM_TOKENS.inc(
+                            "completion", amount=usage["output_tokens"]
+                        )
+                        self.ctx.tokens += (
+                            usage["input_tokens"] + usage["output_tokens"]
+                        )
+
+    return TokenCounter
+
+
+@cache
+def get_llm():
+    from langchain_groq import ChatGroq
+
+    return ChatGroq(
+        model=getenv("MODEL_NAME"),
+        temperature=0,
     )
 
+
+@contextmanager
+def timed_llm(ctx, step):
+    ctx.llm_calls += 1
+    with ctx.timed("llm"), metrics.LLM_SECONDS.time(step):
+        yield
+
+
+def llm_config(ctx):
+    return {"callbacks": [token_counter_class()(ctx)]}
+
+
+@cache
+def get_tool_chain():
+    return get_tool_prompt() | get_llm().bind(tools=TOOLS, tool_choice="auto")
+
+
+@cache
+def get_final_chain():
+    from langchain_core.output_parsers import StrOutputParser
+
+    return get_final_prompt() | get_llm() | StrOutputParser()
+
+
+TOOL_WORKERS = int(getenv("TOOL_WORKERS", "4"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+
+def timed_tool(ctx, tool_name, args):
+    with ctx.timed(f"tool:{tool_name}"), metrics.TOOL_SECONDS.time(tool_name):
+        try:
+            return run_tool(ctx.user_id, tool_name, args)
+        except Exception:
+            metrics.TOOL_ERRORS.inc(tool_name)
+            raise
+
+
+def run_tool_batch(ctx, batch, results):
+    if len(batch) == 1:
+        index, tool_name, args = batch[0]
+        results[index] = timed_tool(ctx, tool_name, args)
+        return
+    futures = [
+        (index, tool_executor.submit(timed_tool, ctx, tool_name, args))
+        for index, tool_name, args in batch
+    ]
+    for index, future in futures:
+        results[index] = future.result()
+
+
+def execute_tool(ctx, message):
+    tool_results = []
+    if isinstance(message, dict):
+        tool_calls = message.get("tool_calls", [])
+    else:
+        tool_calls = getattr(message, "tool_calls", [])
+
+    if tool_calls:
+        calls = []
+        for tool_call in tool_calls:
+            args = (
+                tool_call["args"]
+                if isinstance(tool_call, dict)
+                else json.loads(tool_call.args)
+            )
+            tool_name = (
+                tool_call["name"] if isinstance(tool_call, dict) else tool_call.name
+            )
+            ctx.record_tool_call(tool_name, args)
+            logger.debug("%s; %s; %s", ctx.user_id, tool_name, args)
+            calls.append((tool_name, args))
+
+        # Consecutive read-only calls run concurrently. A write waits for the
+        # reads before it and runs alone, so writes keep their order and
+        # reads never observe a half-applied turn.
+        results = [None] * len(calls)
+        batch = []
+        for index, (tool_name, args) in enumerate(calls):
+            if tool_name in READ_ONLY_TOOLS:
+                batch.append((index, tool_name, args))
+                continue
+            if batch:
+                run_tool_batch(ctx, batch, results)
+                batch = []
+            results[index] = timed_tool(ctx, tool_name, args)
+        if batch:
+            run_tool_batch(ctx, batch, results)
+
+        for (tool_name, _), result in zip(calls, results):
+            tool_results.append({"tool": tool_name, "result": result})
+        logger.debug("%s", tool_results)
+    return {
+        "tool_results": tool_results,
+        "tool_calls": [],
+    }
+
+
+def tool_inputs(ctx):
+    return {
+        "current_time": get_current_timestamptz(),
+        "question": ctx.question,
+        "tool_results": encode_results(ctx.tool_results),
+    }
+
+
+def final_inputs(ctx):
     return {
-        "answer": final_answer,
-        "tools_called": json.dumps(tools_called),
-        "tools_results": json.dumps(state["tool_results"]),
+        "question": ctx.question,
+        "tool_results": encode_results(ctx.tool_results),
     }
+
+
+MAX_ITERATIONS = 5
+
+
+def direct_answer(ctx, message):
+    if not ctx.tool_calls:
+        # The model answered (or asked for clarification) without tools.
+        ctx.path = "direct"
+        return getattr(message, "content", None) or None
+    ctx.path = "template"
+    return renderers.render(ctx)
+
+
+def run_tool_loop(ctx):
+    for _ in range(MAX_ITERATIONS):
+        ctx.iterations += 1
+        with timed_llm(ctx, "tools"):
+            message = get_tool_chain().invoke(tool_inputs(ctx), llm_config(ctx))
+        result = execute_tool(ctx, message)
+        ctx.tool_results = result["tool_results"]
+        if not result.get("tool_calls"):
+            break
+    return message
+
+
+async def arun_tool_loop(ctx):
+    for _ in range(MAX_ITERATIONS):
+        ctx.iterations += 1
+        with timed_llm(ctx, "tools"):
+            message = await get_tool_chain().ainvoke(tool_inputs(ctx), llm_config(ctx))
+        # Tools are synchronous, run them off the event loop.
+        result = await asyncio.to_thread(execute_tool, ctx, message)
+        ctx.tool_results = result["tool_results"]
+        if not result.get("tool_calls"):
+            break
+    return message
+
+
+def run_full_chain(ctx):
+    message = run_tool_loop(ctx)
+
+    ctx.answer = direct_answer(ctx, message)
+    if ctx.answer is None:
+        ctx.path = "llm"
+        with timed_llm(ctx, "final"):
+            ctx.answer = get_final_chain().invoke(final_inputs(ctx), llm_config(ctx))
+    return ctx
+
+
+async def arun_full_chain(ctx):
+    message = await arun_tool_loop(ctx)
+
+    ctx.answer = direct_answer(ctx, message)
+    if ctx.answer is None:
+        ctx.path = "llm"
+        with timed_llm(ctx, "final"):
+            ctx.answer = await get_final_chain().ainvoke(
+                final_inputs(ctx), llm_config(ctx)
+            )
+    return ctx
+
+
+def stream_response(user_id, question, data_version=None, message_id=None):
+    ticket = prompt_flights.join(user_id, question, message_id)
+    if not ticket.leader:
+        answer = ticket.wait()
+        if answer is not None:
+            yield answer
+            return
+
+    ctx = RequestContext(user_id=user_id, question=question, data_version=data_version)
+    started = perf_counter()
+    try:
+        if prepare_answer(ctx):
+            yield ctx.answer
+        else:
+            with admit(ctx):
+                message = run_tool_loop(ctx)
+                ctx.answer = direct_answer(ctx, message)
+                if ctx.answer is not None:
+                    yield ctx.answer
+                else:
+                    ctx.path = "llm"
+                    chunks = []
+                    with timed_llm(ctx, "final"):
+                        for chunk in get_final_chain().stream(
+                            final_inputs(ctx), llm_config(ctx)
+                        ):
+                            chunks.append(chunk)
+                            yield chunk
+                    ctx.answer = "".join(chunks)
+    finally:
+        ticket.finish(ctx.answer)
+    ctx.add_timing("total", perf_counter() - started)
+    finish_response(ctx)
+
+
+async def astream_response(user_id, question, data_version=None, message_id=None):
+    ticket = await asyncio.to_thread(prompt_flights.join, user_id, question, message_id)
+    if not ticket.leader:
+        answer = await asyncio.to_thread(ticket.wait)
+        if answer is not None:
+            yield answer
+            return
+
+    ctx = RequestContext(user_id=user_id, question=question, data_version=data_version)
+    started = perf_counter()
+    try:
+        if await asyncio.to_thread(prepare_answer, ctx):
+            yield ctx.answer
+        else:
+            async with aadmit(ctx):
+                message = await arun_tool_loop(ctx)
+                ctx.answer = direct_answer(ctx, message)
+                if ctx.answer is not None:
+                    yield ctx.answer
+                else:
+                    ctx.path = "llm"
+                    chunks = []
+                    with timed_llm(ctx, "final"):
+                        async for chunk in get_final_chain().astream(
+                            final_inputs(ctx), llm_config(ctx)
+                        ):
+                            chunks.append(chunk)
+                            yield chunk
+                    ctx.answer = "".join(chunks)
+    finally:
+        await asyncio.to_thread(ticket.finish, ctx.answer)
+    ctx.add_timing("total", perf_counter() - started)
+    finish_response(ctx)
@@ -0,0 +1,49 @@
+import json
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+
+
+@dataclass
+class RequestContext:
+    user_id: int
+    question: str
+    tool_calls: list = field(default_factory=list)
+    tool_results: list = field(default_factory=list)
+    timings: dict = field(default_factory=dict)
+    answer: str = None
+    data_version: int = None
+    from_cache: bool = False
+    path: str = None
+    iterations: int = 0
+    llm_calls: int = 0
+    tokens: int = 0
+    _lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    def record_tool_call(self, tool_name, args):
+        self.tool_calls.append({"name": tool_name, "args": args})
+
+    def add_timing(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, stage):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, perf_counter() - started)
+
+    def tools_called_json(self):
+        # Same shape execution_log has always stored.
+        return json.dumps(
+            [
+                f"Tool called: {call['name']} with arguments: {call['args']}"
+                for call in self.tool_calls
+            ]
+        )
+
+    def tools_results_json(self):
+        return json.dumps(self.tool_results, default=str)
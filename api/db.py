@@ -1,53 +1,217 @@
+from contextlib import contextmanager
+from functools import cache
 from os import getenv
+from threading import Lock, Semaphore
+from time import monotonic, perf_counter
 
+import metrics
 import psycopg2
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 load_dotenv()
 
+DB_POOL_MIN = int(getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT", "30"))
+# Connections idle for longer than this are pinged before being handed out.
+DB_POOL_CHECK_IDLE = float(getenv("DB_POOL_CHECK_IDLE", "30"))
+DB_POOL_RETRIES = 3
+# Telegram gives up redelivering an update after a day.
+UPDATE_RETENTION_HOURS = float(getenv("UPDATE_RETENTION_HOURS", "24"))
+UPDATE_CLEANUP_INTERVAL = 600
 
-def log_tools(user_id, question, tools_called, response, tools_results):
-    sql_string = "INSERT INTO execution_log (user_id, question, tools_called, ai_response, tools_results) VALUES (%s, %s, %s, %s, %s)"
+_pool = None
+_pool_lock = Lock()
+_next_update_cleanup = 0.0
+_slots = Semaphore(DB_POOL_MAX)
+_last_used = {}
+_stats_lock = Lock()
+_stats = {
+    "in_use": 0,
+    "waiting": 0,
+    "checkouts": 0,
+    "timeouts": 0,
+    "reconnects": 0,
+    "checkout_seconds_total": 0.0,
+    "checkout_seconds_max": 0.0,
+}
 
-    connection = psycopg2.connect(
-        host="postgres",
-        database=getenv("DB_NAME"),
-        user=getenv("DB_USER"),
-        password=getenv("DB_USER_PASSWORD"),
-        port="5432",
-    )
 
-    with connection.cursor() as cur:
-        cur.execute(
-            sql_string, (user_id, question, tools_called, response, tools_results)
-        )
-        connection.commit()
+class PoolTimeout(Exception):
+    pass
 
-    connection.close()
-    cur.close()
 
+@cache
+def timed_cursor_class(base):
+    class TimedCursor(base):
+        def execute(self, query, vars=None):
+            with metrics.DB_EXECUTE_SECONDS.time():
+                return super().execute(query, vars)
 
-def get_user_registered(user_id):
-    sql_string = "SELECT id FROM users WHERE telegram_id = %s"
-
-    connection = psycopg2.connect(
-        host="postgres",
-        database=getenv("DB_NAME"),
-        user=getenv("DB_USER"),
-        password=getenv("DB_USER_PASSWORD"),
-        port="5432",
+    return TimedCursor
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    # Wraps whatever cursor_factory the caller asks for (RealDictCursor in
+    # most tools) so every execute is timed.
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        base = cursor_factory or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(*args, cursor_factory=timed_cursor_class(base), **kwargs)
+
+
+def connection_params():
+    return {
+        "host": getenv("DB_HOST", "postgres"),
+        "database": getenv("DB_NAME"),
+        "user": getenv("DB_USER"),
+        "password": getenv("DB_USER_PASSWORD"),
+        "port": getenv("DB_PORT", "5432"),
+    }
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    connection_factory=TimedConnection,
+                    **connection_params(),
+                )
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is None or monotonic() - last_used < DB_POOL_CHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _discard(pool, conn):
+    _last_used.pop(id(conn), None)
+    pool.putconn(conn, close=True)
+    with _stats_lock:
+        _stats["reconnects"] += 1
+
+
+def _checkout():
+    pool = get_pool()
+    for _ in range(DB_POOL_RETRIES):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _discard(pool, conn)
+    raise psycopg2.OperationalError("could not obtain a healthy connection")
+
+
+@contextmanager
+def connection():
+    started = perf_counter()
+    with _stats_lock:
+        _stats["waiting"] += 1
+    acquired = _slots.acquire(timeout=DB_POOL_TIMEOUT)
+    with _stats_lock:
+        _stats["waiting"] -= 1
+        if not acquired:
+            _stats["timeouts"] += 1
+    if not acquired:
+        raise PoolTimeout(f"no connection available after {DB_POOL_TIMEOUT}s")
+
+    try:
+        conn = _checkout()
+    except Exception:
+        _slots.release()
+        raise
+
+    elapsed = perf_counter() - started
+    metrics.DB_CONNECT_SECONDS.observe(elapsed)
+    with _stats_lock:
+        _stats["in_use"] += 1
+        _stats["checkouts"] += 1
+        _stats["checkout_seconds_total"] += elapsed
+        _stats["checkout_seconds_max"] = max(_stats["checkout_seconds_max"], elapsed)
+
+    pool = get_pool()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if broken or conn.closed:
+            _discard(pool, conn)
+        else:
+            if (
+                conn.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            ):
+                conn.rollback()
+            _last_used[id(conn)] = monotonic()
+            pool.putconn(conn)
+        with _stats_lock:
+            _stats["in_use"] -= 1
+        _slots.release()
+
+
+def pool_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["min_size"] = DB_POOL_MIN
+    stats["max_size"] = DB_POOL_MAX
+    stats["checkout_seconds_avg"] = (
+        stats["checkout_seconds_total"] / stats["checkouts"]
+        if stats["checkouts"]
+        else 0.0
     )
+    return stats
+
 
-    with connection.cursor() as cursor:
-        cursor.execute(sql_string, (user_id,))
+metrics.register_stats("ponyfin_db_pool", pool_stats)
 
-        try:
-            id = cursor.fetchone()
-        except psycopg2.Error:
-            return False
 
-    connection.close()
-    cursor.close()
+def log_tools_batch(rows):
+    sql_string = "INSERT INTO execution_log (user_id, question, tools_called, ai_response, tools_results, date) VALUES %s"
+
+    with connection() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, sql_string, rows, page_size=len(rows))
+        conn.commit()
+
+
+def get_user_registered(user_id):
+    sql_string = "SELECT id, data_version FROM users WHERE telegram_id = %s"
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_string, (user_id,))
+
+            try:
+                id = cursor.fetchone()
+            except psycopg2.Error:
+                return False
 
     return id
 
@@ -55,20 +219,38 @@ def get_user_registered(user_id):
 def insert_user(payload):
     sql_string = "INSERT INTO users (telegram_id, name) VALUES (%s, %s) RETURNING id, registration_date"
 
-    connection = psycopg2.connect(
-        host="postgres",
-        database=getenv("DB_NAME"),
-        user=getenv("DB_USER"),
-        password=getenv("DB_USER_PASSWORD"),
-        port="5432",
-    )
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_string, (payload["telegram_id"], payload["name"]))
+            row = cursor.fetchone()
+        conn.commit()
 
-    with connection.cursor() as cursor:
-        cursor.execute(sql_string, (payload["telegram_id"], payload["name"]))
-        row = cursor.fetchone()
-        connection.commit()
+    return [row[0], row[1]]
 
-    connection.close()
-    cursor.close()
 
-    return [row[0], row[1]]
+def claim_update(update_id):
+    global _next_update_cleanup
+    sql_string = "INSERT INTO telegram_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING update_id"
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_string, (update_id,))
+            claimed = cursor.fetchone() is not None
+            if monotonic() >= _next_update_cleanup:
+                _next_update_cleanup = monotonic() + UPDATE_CLEANUP_INTERVAL
+                cursor.execute(
+                    "DELETE FROM telegram_updates WHERE received_at < now() - %s * interval '1 hour'",
+                    (UPDATE_RETENTION_HOURS,),
+                )
+        conn.commit()
+
+    return claimed
+
+
+def release_update(update_id):
+    sql_string = "DELETE FROM telegram_updates WHERE update_id = %s"
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_string, (update_id,))
+        conn.commit()
@@ -0,0 +1,106 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from os import getenv
+
+import pytz
+
+# Roughly 4 characters per token for the JSON we produce.
+CHARS_PER_TOKEN = 4
+TOOL_RESULT_TOKEN_BUDGET = int(getenv("TOOL_RESULT_TOKEN_BUDGET", "1500"))
+# Columns that never help the model: every row belongs to the current user.
+INTERNAL_COLUMNS = {"user_id"}
+LOCAL_TZ = pytz.timezone("Europe/Kyiv")
+
+
+def compact_value(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(LOCAL_TZ)
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def table(rows):
+    columns = [column for column in rows[0] if column not in INTERNAL_COLUMNS]
+    return {
+        "columns": columns,
+        "rows": [
+            [compact_value(row.get(column)) for column in columns] for row in rows
+        ],
+    }
+
+
+def compact_result(result):
+    if isinstance(result, dict) and "rows" in result and "next_cursor" in result:
+        encoded = compact_result(result["rows"])
+        # The model cannot ask for the next page within a prompt, so it is
+        # only told that one exists.
+        if result["next_cursor"]:
+            encoded["more"] = True
+        return encoded
+    if (
+        isinstance(result, list)
+        and result
+        and all(isinstance(row, dict) for row in result)
+    ):
+        return table(result)
+    if isinstance(result, list):
+        return {"columns": [], "rows": []} if not result else result
+    if isinstance(result, dict):
+        return {
+            key: compact_value(value)
+            for key, value in result.items()
+            if key not in INTERNAL_COLUMNS
+        }
+    return compact_value(result)
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def truncate(encoded, keep):
+    rows = encoded["rows"]
+    omitted = rows[keep:]
+    encoded["rows"] = rows[:keep]
+    previous = encoded.get("omitted", {})
+    marker = {"rows": len(omitted) + previous.get("rows", 0)}
+    # Keep the totals of what was cut so sums stay correct; amounts in
+    # different currencies are never added up, and without a currency
+    # column only the count is kept.
+    columns = encoded["columns"]
+    if "amount" in columns and "currency" in columns:
+        amount = columns.index("amount")
+        currency = columns.index("currency")
+        totals = dict(previous.get("amount", {}))
+        for row in omitted:
+            totals[row[currency]] = totals.get(row[currency], 0) + (row[amount] or 0)
+        marker["amount"] = totals
+    encoded["omitted"] = marker
+
+
+def encode_results(tool_results, token_budget=TOOL_RESULT_TOKEN_BUDGET):
+    encoded = [
+        {"tool": item["tool"], "result": compact_result(item["result"])}
+        for item in tool_results
+    ]
+    text = dumps(encoded)
+    while len(text) > token_budget * CHARS_PER_TOKEN:
+        tables = [
+            item["result"]
+            for item in encoded
+            if isinstance(item["result"], dict)
+            and len(item["result"].get("rows", [])) > 1
+            and "columns" in item["result"]
+        ]
+        if not tables:
+            break
+        largest = max(tables, key=lambda result: len(result["rows"]))
+        truncate(largest, len(largest["rows"]) // 2)
+        text = dumps(encoded)
+    return text
@@ -0,0 +1,145 @@
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+
+import tools
+from db import connection
+
+# Arguments shaped like the ones the model sends for each tool.
+SAMPLE_ARGS = {
+    "list_categories": {},
+    "get_expenses": {
+        "start_date": "{month_start}",
+        "end_date": "{now}",
+        "sort_by": "date",
+        "limit": 50,
+    },
+    "summarize_expenses": {
+        "category_id": "{category_id}",
+        "start_date": "{month_start}",
+        "end_date": "{now}",
+    },
+    "get_incomes": {"currency": "UAH", "start_date": "{month_start}"},
+    "summarize_incomes": {"start_date": "{month_start}", "end_date": "{now}"},
+    "get_budgets": {"month": "{month}", "year": "{year}"},
+    "check_budget": {"month": "{month}", "year": "{year}"},
+    "get_financial_advice": {},
+    "query_data": {"table": "expenses", "filters": {"currency": "UAH"}, "limit": 20},
+    "delete_category": {"id": "{category_id}"},
+    "update_expense": {"id": 0, "amount": 1},
+    "delete_expense": {"id": 0},
+}
+
+
+class ExplainCursor:
+    def __init__(self, cursor, tool_name, analyze):
+        self.cursor = cursor
+        self.tool_name = tool_name
+        self.prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+
+    def execute(self, query, params=None):
+        self.cursor.execute(self.prefix + query, params)
+        plan = "\n".join(row[0] for row in self.cursor.fetchall())
+        print(f"--- {self.tool_name}\n{plan}\n", flush=True)
+        self.cursor.execute("SELECT NULL")
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ExplainConnection:
+    def __init__(self, conn, tool_name, analyze):
+        self.conn = conn
+        self.tool_name = tool_name
+        self.analyze = analyze
+
+    def cursor(self, *args, **kwargs):
+        # Plans are read positionally, so the tool's cursor_factory is ignored.
+        return ExplainCursor(self.conn.cursor(), self.tool_name, self.analyze)
+
+    def commit(self):
+        pass
+
+
+def sample_values(user_id):
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT id FROM categories WHERE user_id = %s LIMIT 1", (user_id,)
+            )
+            row = cursor.fetchone()
+    now = datetime.now()
+    return {
+        "category_id": row[0] if row else 0,
+        "now": now.isoformat(),
+        "month_start": now.replace(day=1, hour=0, minute=0, second=0).isoformat(),
+        "month": now.month,
+        "year": now.year,
+    }
+
+
+def fill(value, values):
+    if isinstance(value, dict):
+        return {key: fill(item, values) for key, item in value.items()}
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}"):
+        return values[value[1:-1]]
+    return value
+
+
+def busiest_user():
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id FROM expenses GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"
+            )
+            row = cursor.fetchone()
+    if row is None:
+        raise SystemExit("No expenses to explain, seed the database first")
+    return row[0]
+
+
+def explain_tool(tool_name, user_id, args, analyze):
+    with connection() as conn:
+
+        @contextmanager
+        def explain_connection():
+            yield ExplainConnection(conn, tool_name, analyze)
+
+        original = tools.connection
+        tools.connection = explain_connection
+        try:
+            tools.run_tool(user_id, tool_name, args)
+        except (RuntimeError, ValueError):
+            # Tools post-process results that are plans here, not rows.
+            pass
+        finally:
+            tools.connection = original
+            # ANALYZE really runs writes, never keep them.
+            conn.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the query plan of every tool query."
+    )
+    parser.add_argument("--user-id", type=int, help="defaults to the busiest user")
+    parser.add_argument("--analyze", action="store_true", help="use EXPLAIN ANALYZE")
+    parser.add_argument("tools", nargs="*", help="tool names, defaults to all")
+    options = parser.parse_args()
+
+    user_id = options.user_id or busiest_user()
+    values = sample_values(user_id)
+    for tool_name in options.tools or SAMPLE_ARGS:
+        explain_tool(
+            tool_name, user_id, fill(SAMPLE_ARGS[tool_name], values), options.analyze
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import re
+from datetime import datetime, timedelta
+from os import getenv
+from threading import Lock
+
+import metrics
+from templates import fastpath_expense_template, fastpath_income_template
+from tools import ROLLUP_TZ, run_tool
+
+FASTPATH_ENABLED = getenv("FASTPATH_ENABLED", "1") == "1"
+FASTPATH_MIN_CONFIDENCE = float(getenv("FASTPATH_MIN_CONFIDENCE", "0.8"))
+FASTPATH_MAX_TOKENS = int(getenv("FASTPATH_MAX_TOKENS", "6"))
+
+CURRENCIES = {
+    "uah": "UAH",
+    "грн": "UAH",
+    "гривень": "UAH",
+    "гривні": "UAH",
+    "₴": "UAH",
+    "usd": "USD",
+    "дол": "USD",
+    "доларів": "USD",
+    "$": "USD",
+    "eur": "EUR",
+    "євро": "EUR",
+    "€": "EUR",
+}
+DAY_OFFSETS = {"today": 0, "сьогодні": 0, "yesterday": 1, "вчора": 1}
+# Questions, negations and commands about existing records; a message with
+# any of them is never recorded as an entry.
+STOP_WORDS = {
+    "скільки",
+    "чи",
+    "не",
+    "ні",
+    "покажи",
+    "показати",
+    "який",
+    "яка",
+    "яке",
+    "які",
+    "що",
+    "де",
+    "коли",
+    "чому",
+    "як",
+    "всього",
+    "видали",
+    "видалити",
+    "зміни",
+    "змінити",
+    "виправ",
+    "скасуй",
+    "how",
+    "what",
+    "show",
+    "not",
+    "no",
+    "delete",
+    "remove",
+}
+# Lost per word that matches no category: one stray word is enough to send
+# an exact category match to the model.
+UNMATCHED_WORD_PENALTY = 0.25
+TOKEN_RE = re.compile(r"\+?\d+(?:[.,]\d+)?|[$€₴]|[^\W\d_][\w'’-]*")
+
+_stats_lock = Lock()
+_stats = {"attempts": 0, "hits": 0, "misses": 0}
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result["hit_rate"] = (
+        result["hits"] / result["attempts"] if result["attempts"] else 0.0
+    )
+    return result
+
+
+metrics.register_stats("ponyfin_fastpath", stats)
+
+
+def parse_entry(text):
+    tokens = TOKEN_RE.findall(text.lower())
+    if not tokens or len(tokens) > FASTPATH_MAX_TOKENS:
+        return None
+    if STOP_WORDS.intersection(tokens):
+        return None
+    if len(TOKEN_RE.sub("", text.lower()).strip(" ,.!")) > 0:
+        # Punctuation such as "?" or ":" hints at a question, not an entry.
+        return None
+
+    amounts = [token for token in tokens if token[-1].isdigit()]
+    if len(amounts) != 1 or not amounts[0].lstrip("+").isdigit():
+        return None
+    entry = {
+        "kind": "income" if amounts[0].startswith("+") else "expense",
+        "amount": int(amounts[0].lstrip("+")),
+        "currency": None,
+        "days_ago": None,
+        "words": [],
+    }
+    for token in tokens:
+        if token is amounts[0]:
+            continue
+        if token in CURRENCIES:
+            if entry["currency"] is not None:
+                return None
+            entry["currency"] = CURRENCIES[token]
+        elif token in DAY_OFFSETS:
+            if entry["days_ago"] is not None:
+                return None
+            entry["days_ago"] = DAY_OFFSETS[token]
+        else:
+            entry["words"].append(token)
+    if entry["amount"] <= 0:
+        return None
+    return entry
+
+
+def match_category(words, categories):
+    best = None
+    for category in categories:
+        name = category["name"].lower()
+        for word in words:
+            # A shared stem catches inflections such as "кава" / "каву".
+            stem = word[: max(3, len(word) - 1)]
+            if word == name:
+                score = 0.5
+            elif (
+                len(word) >= 4
+                and len(name) >= 4
+                and (name.startswith(stem) or word.startswith(name))
+            ):
+                score = 0.35
+            else:
+                continue
+            if best is None or score > best[1]:
+                best = (category, score, word)
+    return best
+
+
+def expense_confidence(entry, user_id):
+    if not entry["words"]:
+        return 0.0, None
+    categories = run_tool(user_id, "list_categories", {})
+    phrase = " ".join(entry["words"])
+    for category in categories:
+        if category["name"].lower() == phrase:
+            return 1.0, {"category": category, "description": None}
+    match = match_category(entry["words"], categories)
+    if match is None:
+        return 0.0, None
+    category, score, word = match
+    description = [other for other in entry["words"] if other != word]
+    return 0.5 + score - UNMATCHED_WORD_PENALTY * len(description), {
+        "category": category,
+        "description": " ".join(description) or None,
+    }
+
+
+def income_confidence(entry):
+    # incomes.source is required, so a bare "+500" goes to the model, which
+    # asks where the money came from.
+    if not entry["words"] or len(entry["words"]) > 2:
+        return 0.0, None
+    return 1.0, {"source": " ".join(entry["words"])}
+
+
+def entry_date(entry):
+    now = datetime.now(ROLLUP_TZ) - timedelta(days=entry["days_ago"] or 0)
+    return now.strftime("%Y-%m-%d %H:%M:%S%z")
+
+
+def try_handle(ctx):
+    if not FASTPATH_ENABLED:
+        return False
+    _count("attempts")
+    entry = parse_entry(ctx.question)
+    if entry is None:
+        _count("misses")
+        return False
+
+    if entry["kind"] == "expense":
+        confidence, details = expense_confidence(entry, ctx.user_id)
+    else:
+        confidence, details = income_confidence(entry)
+    if confidence < FASTPATH_MIN_CONFIDENCE:
+        _count("misses")
+        return False
+
+    date = entry_date(entry)
+    currency = entry["currency"] or "UAH"
+    if entry["kind"] == "expense":
+        tool_name = "add_expense"
+        args = {
+            "amount": entry["amount"],
+            "currency": currency,
+            "date": date,
+            "category_id": details["category"]["id"],
+            "description": details["description"],
+        }
+        answer = fastpath_expense_template.format(
+            amount=entry["amount"],
+            currency=currency,
+            category=details["category"]["name"],
+            date=date[:10],
+        )
+    else:
+        tool_name = "add_income"
+        args = {
+            "amount": entry["amount"],
+            "currency": currency,
+            "date": date,
+            "source": details["source"],
+        }
+        answer = fastpath_income_template.format(
+            amount=entry["amount"],
+            currency=currency,
+            source=f" ({details['source']})",
+            date=date[:10],
+        )
+
+    ctx.record_tool_call(tool_name, args)
+    with ctx.timed(f"tool:{tool_name}"):
+        result = run_tool(ctx.user_id, tool_name, args)
+    ctx.tool_results = [{"tool": tool_name, "result": result}]
+    ctx.answer = answer
+    _count("hits")
+    return True
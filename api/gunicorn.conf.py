@@ -0,0 +1,47 @@
+import os
+from os import getenv
+
+bind = getenv("BIND", "0.0.0.0:8000")
+workers = int(getenv("GUNICORN_WORKERS", "4"))
+# Admission splits the model quota and per-user rates between the workers.
+os.environ.setdefault("ADMISSION_WORKERS", str(workers))
+# Requests mostly wait on the model and Postgres, so each worker serves
+# several at once; keep threads at or below DB_POOL_MAX.
+threads = int(getenv("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+# Imports the app and applies migrations once in the master; workers are
+# forked from it ready to go.
+preload_app = getenv("GUNICORN_PRELOAD", "1") == "1"
+timeout = int(getenv("GUNICORN_TIMEOUT", "180"))
+# On SIGTERM workers stop accepting and get this long to finish the prompts
+# they are answering.
+graceful_timeout = int(getenv("GUNICORN_GRACEFUL_TIMEOUT", "180"))
+keepalive = 5
+
+
+def pre_fork(server, worker):
+    import chains
+    import db
+    import warmup
+
+    # Connections opened while preloading must not be shared with the
+    # workers; each one opens its own pool.
+    db.close_pool()
+    if server.cfg.preload_app and warmup.LLM_WARMUP != "lazy":
+        # Imported once so the workers share the modules copy-on-write;
+        # clients are still built in each worker.
+        chains.import_llm_stack()
+
+
+def post_worker_init(worker):
+    import warmup
+
+    # Runs before the worker accepts connections, so /health only passes
+    # once the pool is open and the tool schema checked.
+    warmup.warmup()
+
+
+def worker_exit(server, worker):
+    import warmup
+
+    warmup.shutdown()
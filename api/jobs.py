@@ -0,0 +1,380 @@
+import json
+import logging
+import os
+import threading
+import urllib.error
+import urllib.request
+from os import getenv
+from time import monotonic
+from urllib.parse import urlsplit
+
+import metrics
+import psycopg2
+from admission import Overloaded
+from chains import make_response
+from db import connection
+from psycopg2.extras import RealDictCursor
+
+JOB_WORKERS = int(getenv("JOB_WORKERS", "4"))
+JOB_POLL_INTERVAL = float(getenv("JOB_POLL_INTERVAL", "0.5"))
+# Running jobs not finished by then are failed, e.g. after a worker died.
+JOB_TIMEOUT = float(getenv("JOB_TIMEOUT", "300"))
+JOB_QUEUE_LIMIT = int(getenv("JOB_QUEUE_LIMIT", "1000"))
+JOB_CHAT_LIMIT = int(getenv("JOB_CHAT_LIMIT", "10"))
+JOB_MAX_WAIT = float(getenv("JOB_MAX_WAIT", "25"))
+# Long-polls each hold a server thread, so only this many per process
+# wait; others get the job's current status at once.
+JOB_MAX_WAITERS = int(getenv("JOB_MAX_WAITERS", "4"))
+# A job turned away by admission this many times fails instead of holding
+# up the rest of its chat.
+JOB_MAX_ATTEMPTS = int(getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETENTION_HOURS = float(getenv("JOB_RETENTION_HOURS", "24"))
+# Only callback URLs under this address are accepted, e.g. http://bot:8080;
+# unset refuses every callback_url.
+JOB_CALLBACK_BASE_URL = getenv("JOB_CALLBACK_BASE_URL")
+# A failed callback is retried after 1, 2, 4, ... seconds, then left to the
+# bot to fetch.
+JOB_CALLBACK_RETRIES = int(getenv("JOB_CALLBACK_RETRIES", "3"))
+JOB_REAP_INTERVAL = 30
+JOB_CALLBACK_TIMEOUT = 10
+FINISHED = ("done", "failed")
+
+logger = logging.getLogger(__name__)
+
+_wake = threading.Event()
+_stop = threading.Event()
+_finished = threading.Condition()
+_waiters = threading.BoundedSemaphore(max(JOB_MAX_WAITERS, 1))
+_start_lock = threading.Lock()
+_threads = []
+_pid = None
+_stats_lock = threading.Lock()
+_stats = {"done": 0, "failed": 0, "requeued": 0, "callbacks_failed": 0}
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def find_by_message(cursor, chat_id, message_id):
+    if message_id is None:
+        return None
+    cursor.execute(
+        "SELECT id, status FROM prompt_jobs WHERE chat_id = %s AND message_id = %s",
+        (chat_id, message_id),
+    )
+    return cursor.fetchone()
+
+
+def callback_allowed(url):
+    if not JOB_CALLBACK_BASE_URL:
+        return False
+    base = urlsplit(JOB_CALLBACK_BASE_URL)
+    target = urlsplit(url)
+    return (
+        target.scheme == base.scheme
+        and target.netloc == base.netloc
+        and target.path.startswith(base.path)
+    )
+
+
+def submit(user_id, chat_id, prompt, message_id=None, callback_url=None):
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            existing = find_by_message(cursor, chat_id, message_id)
+            if existing is not None:
+                return {"job_id": existing[0], "status": existing[1]}, False
+
+            cursor.execute(
+                """
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE chat_id = %s)
+                FROM prompt_jobs WHERE status IN ('queued', 'running')
+                """,
+                (chat_id,),
+            )
+            pending, chat_pending = cursor.fetchone()
+            if pending >= JOB_QUEUE_LIMIT:
+                raise Overloaded("job queue is full", 10)
+            if chat_pending >= JOB_CHAT_LIMIT:
+                raise Overloaded("too many pending prompts in this chat", 10)
+
+            cursor.execute(
+                """
+                INSERT INTO prompt_jobs (user_id, chat_id, message_id, prompt, callback_url)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (chat_id, message_id) WHERE message_id IS NOT NULL DO NOTHING
+                RETURNING id, status
+                """,
+                (user_id, chat_id, message_id, prompt, callback_url),
+            )
+            row = cursor.fetchone() or find_by_message(cursor, chat_id, message_id)
+        conn.commit()
+    _wake.set()
+    return {"job_id": row[0], "status": row[1]}, True
+
+
+def get_job(job_id):
+    with connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                SELECT id AS job_id, status, answer, error, chat_id, message_id,
+                       callback_url IS NOT NULL AS callback, callback_status
+                FROM prompt_jobs WHERE id = %s
+                """,
+                (job_id,),
+            )
+            return cursor.fetchone()
+
+
+def wait_job(job_id, wait):
+    # Long-poll: jobs finished in this process wake the waiter at once,
+    # jobs finished by another api process are seen on the next poll.
+    if wait <= 0 or JOB_MAX_WAITERS <= 0 or not _waiters.acquire(blocking=False):
+        return get_job(job_id)
+    try:
+        deadline = monotonic() + min(wait, JOB_MAX_WAIT)
+        while True:
+            job = get_job(job_id)
+            remaining = deadline - monotonic()
+            if job is None or job["status"] in FINISHED or remaining <= 0:
+                return job
+            with _finished:
+                _finished.wait(min(remaining, JOB_POLL_INTERVAL))
+    finally:
+        _waiters.release()
+
+
+def claim():
+    # The oldest runnable job of a chat with nothing older pending; SKIP
+    # LOCKED lets workers in every api process claim concurrently.
+    with connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                """
+                WITH next AS (
+                  SELECT j.id FROM prompt_jobs j
+                  WHERE j.status = 'queued' AND j.run_after <= now()
+                    AND NOT EXISTS (
+                      SELECT 1 FROM prompt_jobs p
+                      WHERE p.chat_id = j.chat_id
+                        AND p.status IN ('queued', 'running') AND p.id < j.id
+                    )
+                  ORDER BY j.id
+                  LIMIT 1
+                  FOR UPDATE SKIP LOCKED
+                )
+                UPDATE prompt_jobs j
+                SET status = 'running', attempts = j.attempts + 1,
+                    locked_until = now() + %s * interval '1 second'
+                FROM next, users u
+                WHERE j.id = next.id AND u.id = j.user_id
+                RETURNING j.id, j.user_id, j.chat_id, j.message_id, j.prompt,
+                          j.callback_url, j.attempts, u.data_version
+                """,
+                (JOB_TIMEOUT,),
+            )
+            job = cursor.fetchone()
+        conn.commit()
+    return job
+
+
+def finish(job, status, answer=None, error=None):
+    # A job reap() already failed keeps that outcome; its callback went out.
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE prompt_jobs
+                SET status = %s, answer = %s, error = %s, finished_at = now(),
+                    locked_until = NULL
+                WHERE id = %s AND status = 'running'
+                """,
+                (status, answer, error, job["id"]),
+            )
+            updated = cursor.rowcount
+        conn.commit()
+    if not updated:
+        logger.warning("job %s finished after it was reaped", job["id"])
+        return
+    _count(status)
+    with _finished:
+        _finished.notify_all()
+    send_callback(job, status, answer, error)
+
+
+def requeue(job, delay):
+    # Keeps its place: later jobs of the chat still wait behind it.
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE prompt_jobs
+                SET status = 'queued', locked_until = NULL,
+                    run_after = now() + %s * interval '1 second'
+                WHERE id = %s AND status = 'running'
+                """,
+                (delay, job["id"]),
+            )
+            updated = cursor.rowcount
+        conn.commit()
+    if updated:
+        _count("requeued")
+
+
+def send_callback(job, status, answer, error):
+    if not job.get("callback_url"):
+        return
+    payload = {
+        "job_id": job["id"],
+        "status": status,
+        "answer": answer,
+        "error": error,
+        "chat_id": job["chat_id"],
+        "message_id": job["message_id"],
+    }
+    data = json.dumps(payload).encode()
+    for attempt in range(JOB_CALLBACK_RETRIES + 1):
+        if attempt:
+            # Stop retrying on shutdown; the bot fetches the result instead.
+            if _stop.wait(2 ** (attempt - 1)):
+                break
+        request = urllib.request.Request(
+            job["callback_url"], data=data, headers={"Content-Type": "application/json"}
+        )
+        try:
+            urllib.request.urlopen(request, timeout=JOB_CALLBACK_TIMEOUT).close()
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning("callback for job %s failed: %s", job["id"], e)
+            continue
+        set_callback_status(job, "sent")
+        return
+    _count("callbacks_failed")
+    set_callback_status(job, "failed")
+
+
+def set_callback_status(job, status):
+    try:
+        with connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE prompt_jobs SET callback_status = %s WHERE id = %s",
+                    (status, job["id"]),
+                )
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.warning("recording callback of job %s failed: %s", job["id"], e)
+
+
+def process(job):
+    try:
+        response = make_response(
+            job["user_id"],
+            job["prompt"],
+            data_version=job["data_version"],
+            message_id=job["message_id"],
+        )
+    except Overloaded as e:
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            finish(job, "failed", error=str(e))
+        else:
+            requeue(job, e.retry_after)
+        return
+    except Exception as e:
+        logger.exception("job %s failed", job["id"])
+        finish(job, "failed", error=str(e))
+        return
+    finish(job, "done", answer=response["answer"])
+
+
+def reap():
+    with connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                UPDATE prompt_jobs
+                SET status = 'failed', error = 'job timed out', finished_at = now(),
+                    locked_until = NULL
+                WHERE status = 'running' AND locked_until < now()
+                RETURNING id, chat_id, message_id, callback_url
+                """)
+            stale = cursor.fetchall()
+            cursor.execute(
+                """
+                DELETE FROM prompt_jobs
+                WHERE finished_at < now() - %s * interval '1 hour'
+                """,
+                (JOB_RETENTION_HOURS,),
+            )
+        conn.commit()
+    for job in stale:
+        _count("failed")
+        send_callback(job, "failed", None, "job timed out")
+
+
+def _run():
+    next_reap = 0.0
+    while not _stop.is_set():
+        try:
+            if monotonic() >= next_reap:
+                next_reap = monotonic() + JOB_REAP_INTERVAL
+                reap()
+            job = claim()
+        except psycopg2.Error as e:
+            logger.warning("job queue unavailable: %s", e)
+            _stop.wait(JOB_POLL_INTERVAL)
+            continue
+        if job is None:
+            _wake.wait(JOB_POLL_INTERVAL)
+            _wake.clear()
+            continue
+        process(job)
+
+
+def ensure_workers():
+    global _pid, _threads
+    # Threads do not survive a fork, see logwriter.
+    if _pid == os.getpid() or JOB_WORKERS <= 0:
+        return
+    with _start_lock:
+        if _pid == os.getpid():
+            return
+        _stop.clear()
+        _pid = os.getpid()
+        _threads = [
+            threading.Thread(target=_run, name=f"job-worker-{i}", daemon=True)
+            for i in range(JOB_WORKERS)
+        ]
+        for thread in _threads:
+            thread.start()
+
+
+def stop(timeout=30):
+    # Workers finish the job they are on; queued jobs stay for the next
+    # process.
+    _stop.set()
+    _wake.set()
+    if _pid == os.getpid():
+        deadline = monotonic() + timeout
+        for thread in _threads:
+            thread.join(max(0.0, deadline - monotonic()))
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    try:
+        with connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*) FILTER (WHERE status = 'queued'),
+                           COUNT(*) FILTER (WHERE status = 'running')
+                    FROM prompt_jobs WHERE status IN ('queued', 'running')
+                    """)
+                result["queued"], result["running"] = cursor.fetchone()
+    except psycopg2.Error:
+        pass
+    return result
+
+
+metrics.register_stats("ponyfin_jobs", stats)
@@ -0,0 +1,134 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from os import getenv
+from time import monotonic
+
+import db
+import metrics
+
+LOG_BUFFER_SIZE = int(getenv("LOG_BUFFER_SIZE", "10000"))
+LOG_BATCH_SIZE = int(getenv("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL = float(getenv("LOG_FLUSH_INTERVAL", "1.0"))
+
+_queue = queue.Queue(maxsize=LOG_BUFFER_SIZE)
+_stop = threading.Event()
+_start_lock = threading.Lock()
+_thread = None
+_pid = None
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+logger = logging.getLogger(__name__)
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def _ensure_started():
+    global _thread, _pid
+    # Threads do not survive a fork, so a preloaded parent's writer is
+    # restarted in each worker on first use.
+    if _thread is not None and _pid == os.getpid() and _thread.is_alive():
+        return
+    with _start_lock:
+        if _thread is None or _pid != os.getpid() or not _thread.is_alive():
+            _stop.clear()
+            _pid = os.getpid()
+            _thread = threading.Thread(target=_run, name="log-writer", daemon=True)
+            _thread.start()
+
+
+def log_tools(ctx):
+    with metrics.LOG_TOOLS_SECONDS.time():
+        enqueue(ctx)
+
+
+def enqueue(ctx):
+    row = (
+        ctx.user_id,
+        ctx.question,
+        ctx.tools_called_json(),
+        ctx.answer,
+        ctx.tools_results_json(),
+        # Rows are written in batches, so keep the time the request finished
+        # rather than the time of the insert.
+        datetime.now(timezone.utc),
+    )
+    _ensure_started()
+    try:
+        _queue.put_nowait(row)
+        _count("enqueued")
+    except queue.Full:
+        _count("dropped")
+
+
+def _write(rows):
+    try:
+        with metrics.LOG_FLUSH_SECONDS.time():
+            db.log_tools_batch(rows)
+        _count("written", len(rows))
+        _count("batches")
+    except Exception as e:
+        _count("failed", len(rows))
+        logger.error("execution_log flush of %d rows failed: %s", len(rows), e)
+
+
+def _drain(limit):
+    rows = []
+    while len(rows) < limit:
+        try:
+            rows.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return rows
+
+
+def _run():
+    while not _stop.is_set():
+        deadline = monotonic() + LOG_FLUSH_INTERVAL
+        rows = []
+        while len(rows) < LOG_BATCH_SIZE and not _stop.is_set():
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            rows.extend(_drain(LOG_BATCH_SIZE - len(rows)))
+        if rows:
+            _write(rows)
+    flush()
+
+
+def flush():
+    while True:
+        rows = _drain(LOG_BATCH_SIZE)
+        if not rows:
+            return
+        _write(rows)
+
+
+def stop(timeout=10):
+    _stop.set()
+    if _thread is not None and _pid == os.getpid() and _thread.is_alive():
+        _thread.join(timeout)
+    else:
+        flush()
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result["queued"] = _queue.qsize()
+    return result
+
+
+metrics.register_stats("ponyfin_log_writer", stats)
+atexit.register(stop)
@@ -1,8 +1,36 @@
+import logging
+from os import getenv
+
 import db
-from chains import make_response
-from flask import Flask, request
+import jobs
+import metrics
+import warmup
+from admission import Overloaded
+from chains import make_response, stream_response
+from flask import Flask, Response, request, stream_with_context
+from migrate import migrate
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
 
 app = Flask(__name__)
+migrate()
+
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    return (
+        {"message": error.reason, "retry_after": error.retry_after},
+        429,
+        {"Retry-After": str(error.retry_after)},
+    )
+
+
+def prepend(first, chunks):
+    yield first
+    yield from chunks
 
 
 @app.route("/users", methods=["POST"])
@@ -21,10 +49,82 @@ def post_user():
 def prompt():
     data = request.json
     user_id = db.get_user_registered(data["user_id"])
+    if user_id and data.get("stream"):
+        chunks = stream_response(
+            user_id=user_id[0],
+            question=data["prompt"],
+            data_version=user_id[1],
+            message_id=data.get("message_id"),
+        )
+        # Run up to the first chunk before responding, so a rejection or a
+        # failed tool loop gets a proper status instead of a broken 200.
+        first = next(chunks, "")
+        return Response(
+            stream_with_context(prepend(first, chunks)), mimetype="text/plain"
+        )
     if user_id:
-        return make_response(user_id=user_id[0], question=data["prompt"])
+        return make_response(
+            user_id=user_id[0],
+            question=data["prompt"],
+            data_version=user_id[1],
+            message_id=data.get("message_id"),
+        )
     return {"message": "Not registered"}, 401
 
 
+@app.route("/jobs", methods=["POST"])
+def post_job():
+    data = request.json
+    user_id = db.get_user_registered(data["user_id"])
+    if not user_id:
+        return {"message": "Not registered"}, 401
+    if data.get("callback_url") and not jobs.callback_allowed(data["callback_url"]):
+        return {"message": "callback_url is not allowed"}, 400
+    job, created = jobs.submit(
+        user_id=user_id[0],
+        chat_id=data.get("chat_id", data["user_id"]),
+        prompt=data["prompt"],
+        message_id=data.get("message_id"),
+        callback_url=data.get("callback_url"),
+    )
+    return job, 202 if created else 200
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.wait_job(job_id, request.args.get("wait", 0, type=float))
+    if job is None:
+        return {"message": "Not found"}, 404
+    return job
+
+
+@app.route("/updates/<int:update_id>", methods=["POST"])
+def claim_update(update_id):
+    # Shared by all bot replicas; only the first claim of an update_id wins.
+    if not db.claim_update(update_id):
+        return {"message": "already received"}, 409
+    return {"message": "success"}, 201
+
+
+@app.route("/updates/<int:update_id>", methods=["DELETE"])
+def release_update(update_id):
+    db.release_update(update_id)
+    return {"message": "success"}
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    if not warmup.ready.is_set():
+        return {"status": "starting"}, 503
+    return {"status": "ok"}
+
+
 if __name__ == "__main__":
+    # Development server; production runs gunicorn with gunicorn.conf.py.
+    warmup.warmup()
     app.run()
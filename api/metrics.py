@@ -0,0 +1,202 @@
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+# Metrics live in process memory, so under gunicorn every worker reports its
+# own numbers; the worker's pid is exported so scrapes can be told apart.
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+ITERATION_BUCKETS = (0, 1, 2, 3, 4, 5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+_stats_sources = []
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape_label(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(
+                f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        self.lock = Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            values = sorted(
+                (labels, list(series)) for labels, series in self.values.items()
+            )
+        for labels, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                bucket_labels = format_labels(
+                    self.labelnames + ("le",), labels + (format_value(float(bound)),)
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {format_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def register_stats(prefix, source):
+    # Modules that already keep a stats() dict expose it as gauges.
+    _stats_sources.append((prefix, source))
+
+
+def render():
+    lines = [
+        "# HELP ponyfin_process_pid Pid of the worker that served this scrape",
+        "# TYPE ponyfin_process_pid gauge",
+        f"ponyfin_process_pid {os.getpid()}",
+    ]
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for prefix, source in _stats_sources:
+        for key, value in sorted(source().items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.append(f"{prefix}_{key} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+PROMPT_SECONDS = Histogram(
+    "ponyfin_prompt_seconds",
+    "Time to answer a /prompt request",
+    ["path"],
+)
+LLM_SECONDS = Histogram(
+    "ponyfin_llm_seconds",
+    "Time of a single LLM call",
+    ["step"],
+)
+TOOL_SECONDS = Histogram(
+    "ponyfin_tool_seconds",
+    "Time of a single tool execution",
+    ["tool"],
+)
+TOOL_ERRORS = Counter(
+    "ponyfin_tool_errors_total",
+    "Tool executions that raised",
+    ["tool"],
+)
+DB_CONNECT_SECONDS = Histogram(
+    "ponyfin_db_connect_seconds",
+    "Time to check a connection out of the pool",
+)
+DB_EXECUTE_SECONDS = Histogram(
+    "ponyfin_db_execute_seconds",
+    "Time of a single cursor execute",
+)
+LOG_TOOLS_SECONDS = Histogram(
+    "ponyfin_log_tools_seconds",
+    "Time log_tools spends on the request path",
+)
+LOG_FLUSH_SECONDS = Histogram(
+    "ponyfin_log_flush_seconds",
+    "Time to write one batch to execution_log",
+)
+LLM_TOKENS = Counter(
+    "ponyfin_llm_tokens_total",
+    "Tokens reported by the model provider",
+    ["kind"],
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "ponyfin_admission_wait_seconds",
+    "Time a prompt waited for the LLM budget",
+)
+LOOP_ITERATIONS = Histogram(
+    "ponyfin_tool_loop_iterations",
+    "Tool loop iterations per answered prompt",
+    buckets=ITERATION_BUCKETS,
+)
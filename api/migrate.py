@@ -0,0 +1,56 @@
+import logging
+from pathlib import Path
+
+import psycopg2
+from db import connection
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+# Arbitrary key for pg_advisory_lock so api workers starting together apply
+# migrations one at a time.
+MIGRATION_LOCK_ID = 7410001
+
+logger = logging.getLogger(__name__)
+
+
+def pending_migrations(applied):
+    return [
+        path
+        for path in sorted(MIGRATIONS_DIR.glob("*.sql"))
+        if path.stem not in applied
+    ]
+
+
+def migrate():
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                      version TEXT PRIMARY KEY,
+                      applied_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                    """)
+                conn.commit()
+                cursor.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cursor.fetchall()}
+                for path in pending_migrations(applied):
+                    try:
+                        cursor.execute(path.read_text())
+                        cursor.execute(
+                            "INSERT INTO schema_migrations (version) VALUES (%s)",
+                            (path.stem,),
+                        )
+                        conn.commit()
+                    except psycopg2.Error:
+                        conn.rollback()
+                        raise
+                    logger.info("Applied migration %s", path.stem)
+            finally:
+                conn.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                conn.commit()
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,3 @@
+-- add_budget, get_budgets and check_budget all read and write budgets.currency,
+-- but the initial schema never created the column.
+ALTER TABLE budgets ADD COLUMN IF NOT EXISTS currency TEXT NOT NULL DEFAULT 'UAH';
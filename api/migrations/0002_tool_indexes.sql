@@ -0,0 +1,17 @@
+-- Every tool filters on user_id first, then on a date range, category or currency.
+CREATE INDEX IF NOT EXISTS expenses_user_date_idx ON expenses (user_id, date);
+CREATE INDEX IF NOT EXISTS expenses_user_category_date_idx ON expenses (user_id, category_id, date);
+CREATE INDEX IF NOT EXISTS expenses_user_currency_date_idx ON expenses (user_id, currency, date);
+-- check_budget joins expenses on category and month; also serves the FK cascade
+-- and delete_category's NOT EXISTS check.
+CREATE INDEX IF NOT EXISTS expenses_category_date_idx ON expenses (category_id, date);
+
+CREATE INDEX IF NOT EXISTS incomes_user_date_idx ON incomes (user_id, date);
+CREATE INDEX IF NOT EXISTS incomes_user_currency_date_idx ON incomes (user_id, currency, date);
+
+CREATE INDEX IF NOT EXISTS budgets_user_period_idx ON budgets (user_id, year, month);
+CREATE INDEX IF NOT EXISTS budgets_category_idx ON budgets (category_id);
+
+CREATE INDEX IF NOT EXISTS categories_user_idx ON categories (user_id);
+
+CREATE INDEX IF NOT EXISTS execution_log_user_date_idx ON execution_log (user_id, date);
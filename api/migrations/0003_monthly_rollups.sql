@@ -0,0 +1,97 @@
+-- Per-user monthly totals kept current by triggers, so summaries over whole
+-- months read a handful of rows instead of every expense and income.
+-- Months are bucketed in Europe/Kyiv, the zone the assistant works in.
+-- There is no FK to users: deleting a user cascades to their expenses and
+-- incomes, and the triggers below bring their rollup rows back to zero.
+CREATE TABLE IF NOT EXISTS expense_rollups (
+  user_id BIGINT NOT NULL,
+  month DATE NOT NULL,
+  category_id BIGINT NOT NULL,
+  currency TEXT NOT NULL,
+  total_amount BIGINT NOT NULL DEFAULT 0,
+  count BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, month, category_id, currency)
+);
+
+CREATE TABLE IF NOT EXISTS income_rollups (
+  user_id BIGINT NOT NULL,
+  month DATE NOT NULL,
+  currency TEXT NOT NULL,
+  total_amount BIGINT NOT NULL DEFAULT 0,
+  count BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, month, currency)
+);
+
+CREATE OR REPLACE FUNCTION rollup_month(value TIMESTAMPTZ) RETURNS DATE AS $$
+  SELECT date_trunc('month', value AT TIME ZONE 'Europe/Kyiv')::date;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION expense_rollups_apply(
+  p_user_id BIGINT, p_date TIMESTAMPTZ, p_category_id BIGINT, p_currency TEXT,
+  p_amount BIGINT, p_count BIGINT
+) RETURNS void AS $$
+  INSERT INTO expense_rollups AS r (user_id, month, category_id, currency, total_amount, count)
+  VALUES (p_user_id, rollup_month(p_date), p_category_id, p_currency, p_amount, p_count)
+  ON CONFLICT (user_id, month, category_id, currency) DO UPDATE
+  SET total_amount = r.total_amount + EXCLUDED.total_amount,
+      count = r.count + EXCLUDED.count;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION income_rollups_apply(
+  p_user_id BIGINT, p_date TIMESTAMPTZ, p_currency TEXT, p_amount BIGINT, p_count BIGINT
+) RETURNS void AS $$
+  INSERT INTO income_rollups AS r (user_id, month, currency, total_amount, count)
+  VALUES (p_user_id, rollup_month(p_date), p_currency, p_amount, p_count)
+  ON CONFLICT (user_id, month, currency) DO UPDATE
+  SET total_amount = r.total_amount + EXCLUDED.total_amount,
+      count = r.count + EXCLUDED.count;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION expense_rollups_trigger() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM expense_rollups_apply(OLD.user_id, OLD.date, OLD.category_id, OLD.currency, -OLD.amount, -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM expense_rollups_apply(NEW.user_id, NEW.date, NEW.category_id, NEW.currency, NEW.amount, 1);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION income_rollups_trigger() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM income_rollups_apply(OLD.user_id, OLD.date, OLD.currency, -OLD.amount, -1);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    PERFORM income_rollups_apply(NEW.user_id, NEW.date, NEW.currency, NEW.amount, 1);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Block writes while backfilling so no row is counted twice or missed.
+LOCK TABLE expenses, incomes IN SHARE ROW EXCLUSIVE MODE;
+
+DELETE FROM expense_rollups;
+INSERT INTO expense_rollups (user_id, month, category_id, currency, total_amount, count)
+SELECT user_id, rollup_month(date), category_id, currency, SUM(amount), COUNT(*)
+FROM expenses
+GROUP BY 1, 2, 3, 4;
+
+DELETE FROM income_rollups;
+INSERT INTO income_rollups (user_id, month, currency, total_amount, count)
+SELECT user_id, rollup_month(date), currency, SUM(amount), COUNT(*)
+FROM incomes
+GROUP BY 1, 2, 3;
+
+DROP TRIGGER IF EXISTS expense_rollups ON expenses;
+CREATE TRIGGER expense_rollups
+AFTER INSERT OR UPDATE OR DELETE ON expenses
+FOR EACH ROW EXECUTE FUNCTION expense_rollups_trigger();
+
+DROP TRIGGER IF EXISTS income_rollups ON incomes;
+CREATE TRIGGER income_rollups
+AFTER INSERT OR UPDATE OR DELETE ON incomes
+FOR EACH ROW EXECUTE FUNCTION income_rollups_trigger();
@@ -0,0 +1,2 @@
+-- Bumped by every write tool; the api response cache keys answers on it.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,28 @@
+-- Prompts accepted by POST /jobs and answered by the api's job workers.
+-- A chat's jobs run one at a time in id order; different chats run in
+-- parallel. A redelivered telegram message maps to its existing job.
+CREATE TABLE IF NOT EXISTS prompt_jobs (
+  id BIGSERIAL PRIMARY KEY,
+  user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+  chat_id BIGINT NOT NULL,
+  message_id BIGINT,
+  prompt TEXT NOT NULL,
+  callback_url TEXT,
+  status TEXT NOT NULL DEFAULT 'queued',
+  answer TEXT,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  run_after TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  locked_until TIMESTAMPTZ,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  finished_at TIMESTAMPTZ
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS prompt_jobs_message
+  ON prompt_jobs (chat_id, message_id) WHERE message_id IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS prompt_jobs_pending
+  ON prompt_jobs (chat_id, id) WHERE status IN ('queued', 'running');
+
+CREATE INDEX IF NOT EXISTS prompt_jobs_finished
+  ON prompt_jobs (finished_at) WHERE finished_at IS NOT NULL;
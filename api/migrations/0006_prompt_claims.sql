@@ -0,0 +1,13 @@
+-- One row per telegram message a prompt was answered for, so a redelivery
+-- or double tap that reaches another api worker waits for the first
+-- answer instead of running the chain (and its writes) again.
+CREATE TABLE IF NOT EXISTS prompt_claims (
+  user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+  message_id BIGINT NOT NULL,
+  answer TEXT,
+  claimed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  finished_at TIMESTAMPTZ,
+  PRIMARY KEY (user_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS prompt_claims_claimed_at ON prompt_claims (claimed_at);
@@ -0,0 +1,8 @@
+-- update_ids accepted by any bot replica, so a redelivery that the load
+-- balancer sends to another replica is dropped there too.
+CREATE TABLE IF NOT EXISTS telegram_updates (
+  update_id BIGINT PRIMARY KEY,
+  received_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS telegram_updates_received_at ON telegram_updates (received_at);
@@ -0,0 +1,3 @@
+-- 'sent' once the callback was accepted, 'failed' once its retries ran out;
+-- the bot only delivers a job itself after a failed callback.
+ALTER TABLE prompt_jobs ADD COLUMN IF NOT EXISTS callback_status TEXT;
@@ -0,0 +1,9 @@
+# Shared by bench and replay; keep it free of heavy imports so replay does
+# not load the model stack.
+
+
+def percentile(values, fraction):
+    # values must be sorted.
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
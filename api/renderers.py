@@ -0,0 +1,165 @@
+from os import getenv
+
+RENDER_MAX_ROWS = int(getenv("RENDER_MAX_ROWS", "5"))
+# Tools whose results always go through the summarization call.
+LLM_SUMMARY_TOOLS = {
+    name.strip()
+    for name in getenv("LLM_SUMMARY_TOOLS", "get_financial_advice,query_data").split(
+        ","
+    )
+    if name.strip()
+}
+
+NOUNS = {
+    "category": ("категорію", "категорії"),
+    "expense": ("витрату", "витрати"),
+    "income": ("дохід", "доходу"),
+    "budget": ("бюджет", "бюджету"),
+}
+
+
+def money(amount, currency=None):
+    if amount is None:
+        amount = 0
+    return f"{amount} {currency}" if currency else f"{amount}"
+
+
+def render_added(noun):
+    def render(args, result):
+        details = ""
+        if "amount" in args:
+            details = f" {money(args['amount'], args.get('currency'))}"
+        elif "name" in args:
+            details = f" «{args['name']}»"
+        return f"Додав {NOUNS[noun][0]}{details}."
+
+    return render
+
+
+def render_updated(noun):
+    def render(args, result):
+        if result:
+            return f"Оновив {NOUNS[noun][0]}."
+        return f"Не знайшов такої {NOUNS[noun][1]}, нічого не змінено."
+
+    return render
+
+
+def render_deleted(noun):
+    def render(args, result):
+        if result:
+            return f"Видалив {NOUNS[noun][0]}."
+        if noun == "category":
+            return "Не вдалося видалити категорію: її не знайдено або до неї прив'язані витрати чи бюджети."
+        return f"Не знайшов такої {NOUNS[noun][1]}, нічого не видалено."
+
+    return render
+
+
+def render_summary(title):
+    def render(args, rows):
+        if len(rows) > RENDER_MAX_ROWS:
+            return None
+        rows = [row for row in rows if row.get("count")]
+        if not rows:
+            return "Записів за цей період не знайдено."
+        currency = args.get("currency")
+        groups = [key for key in rows[0] if key not in ("total_amount", "count")]
+        if not groups:
+            row = rows[0]
+            return f"{title}: {money(row['total_amount'], currency)} (записів: {row['count']})."
+        if groups[0] == "category_id":
+            # Needs category names, which only the model can look up here.
+            return None
+        lines = [f"{title}:"]
+        for row in rows:
+            label = str(row[groups[0]])[:10]
+            lines.append(
+                f"- {label}: {money(row['total_amount'], currency)} (записів: {row['count']})"
+            )
+        return "\n".join(lines)
+
+    return render
+
+
+def render_check_budget(args, rows):
+    if not rows:
+        return "Бюджету на цей період не знайдено."
+    if len(rows) > RENDER_MAX_ROWS:
+        return None
+    lines = []
+    for row in rows:
+        currency = row["currency"]
+        left = row["budget_amount"] - row["spent_amount"]
+        status = (
+            f"залишок {money(left, currency)}"
+            if left >= 0
+            else f"перевищено на {money(-left, currency)}"
+        )
+        # A budget without a category covers all spending in its currency.
+        category = row["category"] or "усі витрати"
+        lines.append(
+            f"Бюджет «{category}» на {row['month']:02d}.{row['year']}:"
+            f" {money(row['budget_amount'], currency)},"
+            f" витрачено {money(row['spent_amount'], currency)}, {status}."
+        )
+    return "\n".join(lines)
+
+
+def render_rows(empty, describe):
+    def render(args, rows):
+        if isinstance(rows, dict):
+            # A page that has more rows after it is left to the model to summarize.
+            if rows.get("next_cursor"):
+                return None
+            rows = rows["rows"]
+        if len(rows) > RENDER_MAX_ROWS:
+            return None
+        if not rows:
+            return empty
+        return "\n".join(f"- {describe(row)}" for row in rows)
+
+    return render
+
+
+def describe_money_row(row):
+    date = str(row.get("date", ""))[:10]
+    label = row.get("description") or row.get("source") or ""
+    return " ".join(
+        part for part in [date, money(row["amount"], row["currency"]), label] if part
+    )
+
+
+RENDERERS = {
+    "list_categories": render_rows(
+        "У вас ще немає категорій.", lambda row: row["name"]
+    ),
+    "add_category": render_added("category"),
+    "update_category": render_updated("category"),
+    "delete_category": render_deleted("category"),
+    "add_expense": render_added("expense"),
+    "get_expenses": render_rows("Витрат не знайдено.", describe_money_row),
+    "update_expense": render_updated("expense"),
+    "delete_expense": render_deleted("expense"),
+    "summarize_expenses": render_summary("Витрати"),
+    "add_income": render_added("income"),
+    "get_incomes": render_rows("Доходів не знайдено.", describe_money_row),
+    "summarize_incomes": render_summary("Доходи"),
+    "add_budget": render_added("budget"),
+    "get_budgets": render_rows(
+        "Бюджетів не знайдено.",
+        lambda row: f"{row['month']:02}.{row['year']}: {money(row['amount'], row.get('currency'))}",
+    ),
+    "check_budget": render_check_budget,
+}
+
+
+# Returns None when the summarization call should run instead.
+def render(ctx):
+    if len(ctx.tool_results) != 1:
+        return None
+    tool_name = ctx.tool_results[0]["tool"]
+    if tool_name in LLM_SUMMARY_TOOLS or tool_name not in RENDERERS:
+        return None
+    args = ctx.tool_calls[-1]["args"]
+    return RENDERERS[tool_name](args, ctx.tool_results[0]["result"])
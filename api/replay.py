@@ -0,0 +1,234 @@
+import argparse
+import ast
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db import connection
+from percentiles import percentile
+from tools import READ_ONLY_TOOLS, run_tool
+
+# execution_log.tools_called holds strings built as
+# f"Tool called: {name} with arguments: {args}", so args is a dict repr.
+TOOL_CALL_RE = re.compile(r"^Tool called: (\w+) with arguments: (.*)$", re.DOTALL)
+MAX_DIFF_SAMPLES = 5
+
+
+def parse_tool_calls(tools_called):
+    if not tools_called:
+        return []
+    try:
+        entries = json.loads(tools_called)
+    except ValueError:
+        entries = ast.literal_eval(tools_called)
+    calls = []
+    for entry in entries:
+        match = TOOL_CALL_RE.match(entry)
+        if match is None:
+            raise ValueError(f"unrecognized tool call: {entry[:100]}")
+        calls.append((match.group(1), ast.literal_eval(match.group(2))))
+    return calls
+
+
+def parse_tool_results(tools_results):
+    try:
+        return [item["result"] for item in json.loads(tools_results or "[]")]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def normalize(result):
+    # Same serialization execution_log uses, so both sides compare as stored.
+    return json.loads(json.dumps(result, default=str))
+
+
+def same_result(logged, replayed):
+    replayed = normalize(replayed)
+    if isinstance(logged, list) and isinstance(replayed, dict) and "rows" in replayed:
+        # Logged before listings were paged: compare the first page only.
+        return replayed["rows"] == logged[: len(replayed["rows"])]
+    return replayed == logged
+
+
+def load_requests(options):
+    filters = []
+    params = []
+    if options.since:
+        filters.append("date >= %s")
+        params.append(options.since)
+    if options.until:
+        filters.append("date < %s")
+        params.append(options.until)
+    if options.user_id:
+        filters.append("user_id = %s")
+        params.append(options.user_id)
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    params.append(options.limit)
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT id, user_id, date, tools_called, tools_results
+                FROM execution_log {where}
+                ORDER BY date, id
+                LIMIT %s
+                """,
+                params,
+            )
+            rows = cursor.fetchall()
+
+    requests = []
+    skipped = 0
+    for log_id, user_id, date, tools_called, tools_results in rows:
+        try:
+            calls = parse_tool_calls(tools_called)
+        except (ValueError, SyntaxError):
+            skipped += 1
+            continue
+        if calls:
+            requests.append(
+                {
+                    "id": log_id,
+                    "user_id": user_id,
+                    "date": date,
+                    "calls": calls,
+                    "results": parse_tool_results(tools_results),
+                }
+            )
+    return requests, skipped
+
+
+class Report:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tools = {}
+
+    def tool(self, name):
+        return self.tools.setdefault(
+            name,
+            {
+                "latencies": [],
+                "errors": 0,
+                "skipped": 0,
+                "compared": 0,
+                "differences": 0,
+                "samples": [],
+            },
+        )
+
+    def record(self, log_id, name, seconds, error, difference):
+        with self.lock:
+            stats = self.tool(name)
+            if seconds is None:
+                stats["skipped"] += 1
+                return
+            stats["latencies"].append(seconds)
+            if error is not None:
+                stats["errors"] += 1
+                if len(stats["samples"]) < MAX_DIFF_SAMPLES:
+                    stats["samples"].append(f"log {log_id}: {error}")
+            if difference is not None:
+                stats["compared"] += 1
+                if difference:
+                    stats["differences"] += 1
+                    if len(stats["samples"]) < MAX_DIFF_SAMPLES:
+                        stats["samples"].append(f"log {log_id}: result differs")
+
+
+def replay_request(request, options, report):
+    logged = request["results"]
+    aligned = logged is not None and len(logged) == len(request["calls"])
+    for index, (name, args) in enumerate(request["calls"]):
+        if name not in READ_ONLY_TOOLS and not options.include_writes:
+            report.record(request["id"], name, None, None, None)
+            continue
+        started = time.perf_counter()
+        try:
+            result = run_tool(request["user_id"], name, args)
+            error = None
+        except (RuntimeError, ValueError) as e:
+            result = None
+            error = str(e)
+        seconds = time.perf_counter() - started
+        difference = None
+        if error is None and aligned and name in READ_ONLY_TOOLS:
+            difference = not same_result(logged[index], result)
+        report.record(request["id"], name, seconds, error, difference)
+
+
+def replay(requests, options):
+    report = Report()
+    if not requests:
+        return report, 0.0
+    first = requests[0]["date"]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        futures = []
+        for request in requests:
+            if options.speed > 0:
+                offset = (request["date"] - first).total_seconds() / options.speed
+                delay = started + offset - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(replay_request, request, options, report))
+        for future in futures:
+            future.result()
+    return report, time.monotonic() - started
+
+
+def print_report(report, requests, skipped, elapsed):
+    print(
+        f"Replayed {len(requests)} logged requests in {elapsed:.1f}s"
+        f" ({skipped} unparsable rows skipped)\n"
+    )
+    print(
+        f"{'tool':<22}{'calls':>7}{'errors':>8}{'skipped':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'diffs':>12}"
+    )
+    for name, stats in sorted(report.tools.items()):
+        latencies = sorted(stats["latencies"])
+        print(
+            f"{name:<22}{len(latencies):>7}{stats['errors']:>8}{stats['skipped']:>9}"
+            f"{percentile(latencies, 0.50) * 1000:>9.1f}"
+            f"{percentile(latencies, 0.95) * 1000:>9.1f}"
+            f"{percentile(latencies, 0.99) * 1000:>9.1f}"
+            f"{(latencies[-1] if latencies else 0.0) * 1000:>9.1f}"
+            f"{stats['differences']:>6}/{stats['compared']:<5}"
+        )
+    for name, stats in sorted(report.tools.items()):
+        for sample in stats["samples"]:
+            print(f"  {name}: {sample}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-run tool calls recorded in execution_log and compare results."
+    )
+    parser.add_argument("--since", help="oldest log date to replay")
+    parser.add_argument("--until", help="log date to stop before")
+    parser.add_argument("--user-id", type=int, help="only this user's requests")
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="1 keeps the logged pacing, 10 replays ten times faster, 0 as fast as possible",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--include-writes",
+        action="store_true",
+        help="also run tools that change data; only use on a disposable snapshot",
+    )
+    options = parser.parse_args()
+
+    requests, skipped = load_requests(options)
+    report, elapsed = replay(requests, options)
+    print_report(report, requests, skipped, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import heapq
+import logging
+from itertools import count
+from os import getenv
+from threading import Event, Lock
+from time import monotonic, sleep
+
+import metrics
+import psycopg2
+from cache import normalize_question
+from db import connection
+
+# A repeat of the same text from the same user within this many seconds is
+# treated as a double tap; a redelivered Telegram message (same message id)
+# is recognised for longer. 0 disables either check.
+PROMPT_COALESCE_WINDOW = float(getenv("PROMPT_COALESCE_WINDOW", "2"))
+PROMPT_COALESCE_ID_WINDOW = float(getenv("PROMPT_COALESCE_ID_WINDOW", "60"))
+PROMPT_COALESCE_WAIT = float(getenv("PROMPT_COALESCE_WAIT", "180"))
+PROMPT_CLAIM_POLL_INTERVAL = 0.2
+PROMPT_CLAIM_CLEANUP_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    def __init__(self):
+        self.done = Event()
+        self.answer = None
+
+
+class Ticket:
+    def __init__(self, group, flight, keys, leader, claim=None):
+        self.group = group
+        self.flight = flight
+        self.keys = keys
+        self.leader = leader
+        # (user_id, message_id) claimed in prompt_claims by this ticket, or
+        # held by another api process when the ticket is remote.
+        self.claim = claim
+        self.remote = False
+
+    def wait(self):
+        # None means the leader failed or took too long; the caller then
+        # answers on its own.
+        if self.remote:
+            return self.group.wait_remote(self)
+        if not self.flight.done.wait(self.group.wait_timeout):
+            return None
+        return self.flight.answer
+
+    def finish(self, answer):
+        if self.leader:
+            self.group.finish(self, answer)
+
+
+class SingleFlight:
+    def __init__(self, text_window, id_window, wait_timeout):
+        self.windows = {"text": text_window, "message": id_window}
+        self.wait_timeout = wait_timeout
+        self.flights = {}
+        self.expiry = []
+        self.sequence = count()
+        self.lock = Lock()
+        self.next_cleanup = 0.0
+        self.stats = {"leaders": 0, "followers": 0, "remote_followers": 0}
+
+    def keys(self, user_id, question, message_id=None):
+        keys = []
+        if message_id is not None and self.windows["message"] > 0:
+            keys.append(("message", user_id, message_id))
+        if self.windows["text"] > 0:
+            keys.append(("text", user_id, normalize_question(question)))
+        return keys
+
+    def join(self, user_id, question, message_id=None):
+        keys = self.keys(user_id, question, message_id)
+        with self.lock:
+            self._expire(monotonic())
+            for key in keys:
+                flight = self.flights.get(key)
+                if flight is not None:
+                    self.stats["followers"] += 1
+                    return Ticket(self, flight, keys, leader=False)
+            flight = Flight()
+            for key in keys:
+                self.flights[key] = flight
+            self.stats["leaders"] += 1
+        ticket = Ticket(self, flight, keys, leader=True)
+        if message_id is not None and self.windows["message"] > 0:
+            ticket.claim = (user_id, message_id)
+            if not self.claim(ticket.claim):
+                # Another api process answers this message; this ticket waits
+                # for it and hands its answer to local followers.
+                ticket.leader = False
+                ticket.remote = True
+                with self.lock:
+                    self.stats["leaders"] -= 1
+                    self.stats["remote_followers"] += 1
+        return ticket
+
+    def claim(self, claim):
+        # The in-memory flights only see one process; the insert decides
+        # which api worker or replica answers a redelivered message. A claim
+        # whose answer expired, or whose leader never finished, is taken over.
+        try:
+            with connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        INSERT INTO prompt_claims (user_id, message_id)
+                        VALUES (%s, %s)
+                        ON CONFLICT (user_id, message_id) DO UPDATE
+                        SET answer = NULL, claimed_at = now(), finished_at = NULL
+                        WHERE (prompt_claims.finished_at IS NULL
+                               AND prompt_claims.claimed_at
+                                   < now() - %s * interval '1 second')
+                           OR prompt_claims.finished_at
+                              < now() - %s * interval '1 second'
+                        RETURNING 1
+                        """,
+                        (*claim, self.wait_timeout, self.windows["message"]),
+                    )
+                    claimed = cursor.fetchone() is not None
+                conn.commit()
+        except psycopg2.Error as e:
+            # Answering twice beats not answering.
+            logger.warning("prompt claim failed: %s", e)
+            return True
+        return claimed
+
+    def wait_remote(self, ticket):
+        answer = None
+        deadline = monotonic() + self.wait_timeout
+        try:
+            while monotonic() < deadline:
+                with connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(
+                            """
+                            SELECT answer FROM prompt_claims
+                            WHERE user_id = %s AND message_id = %s
+                            """,
+                            ticket.claim,
+                        )
+                        row = cursor.fetchone()
+                    conn.rollback()
+                if row is None or row[0] is not None:
+                    # No row: the other process failed and dropped its claim.
+                    answer = row and row[0]
+                    break
+                sleep(PROMPT_CLAIM_POLL_INTERVAL)
+        except psycopg2.Error as e:
+            logger.warning("waiting for prompt claim failed: %s", e)
+        if answer is None:
+            # The caller answers itself and releases local followers then.
+            ticket.leader = True
+            ticket.claim = None
+        else:
+            self.finish(ticket, answer)
+        return answer
+
+    def release(self, claim, answer):
+        now = monotonic()
+        try:
+            with connection() as conn:
+                with conn.cursor() as cursor:
+                    if answer is None:
+                        cursor.execute(
+                            """
+                            DELETE FROM prompt_claims
+                            WHERE user_id = %s AND message_id = %s
+                            """,
+                            claim,
+                        )
+                    else:
+                        cursor.execute(
+                            """
+                            UPDATE prompt_claims SET answer = %s, finished_at = now()
+                            WHERE user_id = %s AND message_id = %s
+                            """,
+                            (answer, *claim),
+                        )
+                    if now >= self.next_cleanup:
+                        self.next_cleanup = now + PROMPT_CLAIM_CLEANUP_INTERVAL
+                        cursor.execute(
+                            """
+                            DELETE FROM prompt_claims
+                            WHERE claimed_at < now() - %s * interval '1 second'
+                            """,
+                            (max(self.wait_timeout, self.windows["message"]) * 2,),
+                        )
+                conn.commit()
+        except psycopg2.Error as e:
+            logger.warning("releasing prompt claim failed: %s", e)
+
+    def finish(self, ticket, answer):
+        if ticket.leader and ticket.claim is not None:
+            self.release(ticket.claim, answer)
+        now = monotonic()
+        with self.lock:
+            for key in ticket.keys:
+                if self.flights.get(key) is not ticket.flight:
+                    continue
+                if answer is None:
+                    del self.flights[key]
+                else:
+                    # Finished answers stay joinable until the window ends.
+                    heapq.heappush(
+                        self.expiry,
+                        (
+                            now + self.windows[key[0]],
+                            next(self.sequence),
+                            key,
+                            ticket.flight,
+                        ),
+                    )
+        ticket.flight.answer = answer
+        ticket.flight.done.set()
+
+    def _expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            _, _, key, flight = heapq.heappop(self.expiry)
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.stats)
+            result["tracked"] = len(self.flights)
+        return result
+
+
+prompt_flights = SingleFlight(
+    PROMPT_COALESCE_WINDOW, PROMPT_COALESCE_ID_WINDOW, PROMPT_COALESCE_WAIT
+)
+metrics.register_stats("ponyfin_coalesce", prompt_flights.snapshot)
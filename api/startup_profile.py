@@ -0,0 +1,143 @@
+import argparse
+import json
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+from time import perf_counter
+
+# python -X importtime writes one line per module to stderr once it is
+# imported: "import time: <self us> | <cumulative us> | <indent><module>",
+# nested imports indented by two spaces and listed before their parent.
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)\s*$")
+# Only /prompt needs these; importing the app must not pull them in.
+LAZY_MODULES = "langchain_core,langchain_groq,langsmith"
+
+
+def profile(module):
+    # Import times only mean something in a fresh interpreter.
+    started = perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+    )
+    wall = perf_counter() - started
+    modules = []
+    errors = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match is None:
+            errors.append(line)
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        modules.append(
+            {
+                "module": name,
+                "depth": (len(indent) - 1) // 2,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            }
+        )
+    if result.returncode != 0:
+        sys.stderr.write("\n".join(errors) + "\n")
+        sys.exit(result.returncode)
+    return target_modules(modules, module), wall
+
+
+def target_modules(modules, module):
+    # Everything since the previous top-level entry was imported by module;
+    # earlier entries belong to interpreter startup.
+    for end in range(len(modules) - 1, -1, -1):
+        if modules[end]["depth"] == 0 and modules[end]["module"] == module:
+            break
+    else:
+        return modules
+    start = end
+    while start > 0 and modules[start - 1]["depth"] > 0:
+        start -= 1
+    return modules[start : end + 1]
+
+
+def by_package(modules):
+    totals = defaultdict(float)
+    for entry in modules:
+        totals[entry["module"].split(".")[0]] += entry["self_ms"]
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def print_report(module, modules, wall, top):
+    total = modules[-1]["cumulative_ms"] if modules else 0.0
+    print(
+        f"import {module}: {total:.0f} ms, {len(modules)} modules"
+        f" ({wall * 1000:.0f} ms including interpreter start)\n"
+    )
+    print(f"{'package':<32}{'self ms':>10}")
+    for name, ms in list(by_package(modules).items())[:top]:
+        print(f"{name:<32}{ms:>10.1f}")
+    print(f"\n{'module':<48}{'self ms':>10}{'cumul ms':>10}")
+    for entry in sorted(modules, key=lambda e: -e["cumulative_ms"])[:top]:
+        print(
+            f"{'  ' * entry['depth'] + entry['module']:<48}"
+            f"{entry['self_ms']:>10.1f}{entry['cumulative_ms']:>10.1f}"
+        )
+
+
+def check(modules, forbidden, budget_ms):
+    failures = []
+    found = {}
+    for entry in modules:
+        name = entry["module"]
+        package = name.split(".")[0]
+        if name in forbidden or package in forbidden:
+            # Report the outermost import of each package.
+            if package not in found or entry["depth"] < found[package]["depth"]:
+                found[package] = entry
+    for entry in found.values():
+        failures.append(f"{entry['module']} is imported at startup")
+    total = modules[-1]["cumulative_ms"] if modules else 0.0
+    if budget_ms and total > budget_ms:
+        failures.append(f"startup imports took {total:.0f} ms, budget {budget_ms} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report the import time of the api per module."
+    )
+    parser.add_argument(
+        "--module", default="main", help="module to import, asgi for the ASGI app"
+    )
+    parser.add_argument("--top", type=int, default=20, help="rows per table")
+    parser.add_argument(
+        "--forbid",
+        default=LAZY_MODULES,
+        help="comma separated modules that must not be imported, '' to allow all",
+    )
+    parser.add_argument(
+        "--budget-ms", type=float, default=0, help="fail above this import time"
+    )
+    parser.add_argument("--output", help="also write the profile to this JSON file")
+    options = parser.parse_args()
+
+    modules, wall = profile(options.module)
+    print_report(options.module, modules, wall, options.top)
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(
+                {"module": options.module, "wall_seconds": wall, "modules": modules},
+                file,
+                indent=2,
+            )
+
+    forbidden = {name for name in options.forbid.split(",") if name}
+    failures = check(modules, forbidden, options.budget_ms)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
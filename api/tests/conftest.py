@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The api modules import each other by name, as when run from api/.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,28 @@
+import fastpath
+from context import RequestContext
+
+
+def test_bare_income_goes_to_the_model(monkeypatch):
+    calls = []
+    monkeypatch.setattr(fastpath, "run_tool", lambda *args: calls.append(args))
+    ctx = RequestContext(user_id=1, question="+500")
+
+    assert fastpath.parse_entry("+500")["kind"] == "income"
+    assert not fastpath.try_handle(ctx)
+    assert calls == []
+
+
+def test_income_with_source_is_recorded(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        fastpath, "run_tool", lambda *args: calls.append(args) or {"id": 1}
+    )
+    ctx = RequestContext(user_id=1, question="+500 зарплата")
+
+    assert fastpath.try_handle(ctx)
+    assert calls[0][1] == "add_income"
+    assert calls[0][2]["source"] == "зарплата"
+
+
+def test_question_is_not_an_expense():
+    assert fastpath.parse_entry("скільки кава 5") is None
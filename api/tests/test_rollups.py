@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytest
+import tools
+from db import connection
+from tools import ROLLUP_TZ
+
+# Each month edge, the DST switch and the ranges below split months at
+# times that differ between Kyiv wall clock and a literal +03:00.
+EDGES = [
+    datetime(2026, 1, 1),
+    datetime(2026, 2, 1),
+    datetime(2026, 3, 1),
+    datetime(2026, 3, 29, 3),
+    datetime(2026, 4, 1),
+    datetime(2026, 5, 1),
+]
+OFFSETS = [timedelta(minutes=minutes) for minutes in (-90, -30, 0, 30, 90)]
+RANGES = [
+    ("2026-01-15 00:00:00+03:00", "2026-04-10 23:59:59+03:00"),
+    ("2026-01-31 23:30:00+03:00", "2026-03-29 03:30:00+03:00"),
+    ("2026-02-01 00:00:00+03:00", "2026-03-31 23:59:59+03:00"),
+    ("2026-02-01 00:00:00", "2026-04-30 23:00:00"),
+    (None, "2026-03-01 00:30:00+03:00"),
+    ("2026-02-28 23:30:00+03:00", None),
+]
+
+
+@pytest.fixture
+def user_id():
+    try:
+        with connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO users (telegram_id, name) VALUES (%s, 'rollup test') RETURNING id",
+                    (-int(datetime.now().timestamp() * 1000),),
+                )
+                user_id = cursor.fetchone()[0]
+            conn.commit()
+    except psycopg2.Error as e:
+        pytest.skip(f"database not available: {e}")
+    try:
+        yield user_id
+    finally:
+        with connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+                cursor.execute(
+                    "DELETE FROM expense_rollups WHERE user_id = %s", (user_id,)
+                )
+                cursor.execute(
+                    "DELETE FROM income_rollups WHERE user_id = %s", (user_id,)
+                )
+            conn.commit()
+
+
+def add_rows(user_id):
+    food = tools.add_category(user_id, "їжа")
+    taxi = tools.add_category(user_id, "таксі")
+    amount = 1
+    for edge in EDGES:
+        for offset in OFFSETS:
+            moment = ROLLUP_TZ.localize(edge) + offset
+            category = food if amount % 2 else taxi
+            currency = "UAH" if amount % 3 else "USD"
+            tools.add_expense(user_id, amount, currency, moment, category)
+            tools.add_income(user_id, amount * 10, currency, moment, "робота")
+            amount += 1
+
+
+def raw(monkeypatch, summarize, *args, **kwargs):
+    with monkeypatch.context() as patch:
+        patch.setattr(tools, "whole_months", lambda start, end: None)
+        return summarize(*args, **kwargs)
+
+
+def rows(result, key=None):
+    return sorted(
+        (row[key] if key else None, row["total_amount"] or 0, row["count"])
+        for row in result
+        if row["count"]
+    )
+
+
+@pytest.mark.parametrize("start_date, end_date", RANGES)
+def test_rollups_match_raw_rows(monkeypatch, user_id, start_date, end_date):
+    add_rows(user_id)
+    for summarize, group_by, key in [
+        (tools.summarize_expenses, None, None),
+        (tools.summarize_expenses, "category", "category_id"),
+        (tools.summarize_expenses, "currency", "currency"),
+        (tools.summarize_incomes, None, None),
+        (tools.summarize_incomes, "currency", "currency"),
+    ]:
+        args = {"start_date": start_date, "end_date": end_date, "group_by": group_by}
+        assert tools.whole_months(start_date, end_date) is not None
+        assert rows(summarize(user_id, **args), key) == rows(
+            raw(monkeypatch, summarize, user_id, **args), key
+        )
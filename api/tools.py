@@ -1,7 +1,11 @@
+import base64
+import json
+import logging
 from datetime import datetime, timedelta
 from os import getenv
 
-import psycopg2
+import pytz
+from db import connection
 from psycopg2.extras import RealDictCursor
 
 TOOLS_JSON = """
@@ -85,7 +89,7 @@ TOOLS_JSON = """
         "type": "function",
         "function": {
             "name": "get_expenses",
-            "description": "Retrieve expenses for the authenticated user with optional filters.",
+            "description": "Retrieve expenses for the authenticated user with optional filters, newest first, or in ascending sort_by order when sort_by is given. Returns at most one page of rows; use narrower filters, or a summarize tool for totals, when more are needed.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -173,7 +177,7 @@ TOOLS_JSON = """
         "type": "function",
         "function": {
             "name": "get_incomes",
-            "description": "Retrieve incomes for the authenticated user with optional filters.",
+            "description": "Retrieve incomes for the authenticated user with optional filters, newest first, or in ascending sort_by order when sort_by is given. Returns at most one page of rows; use narrower filters, or a summarize tool for totals, when more are needed.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -275,7 +279,7 @@ TOOLS_JSON = """
         "type": "function",
         "function": {
             "name": "query_data",
-            "description": "Query any table for the authenticated user with custom filters.",
+            "description": "Query any table for the authenticated user with custom filters, in ascending sort_by order, newest first without sort_by. Returns at most one page of rows; use narrower filters, or a summarize tool for totals, when more are needed.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -295,101 +299,187 @@ TOOLS_JSON = """
 ]
 """
 
+TOOLS = json.loads(TOOLS_JSON)
 
-def get_db_connection():
-    return psycopg2.connect(
-        dbname=getenv("DB_NAME"),
-        user=getenv("DB_USER"),
-        password=getenv("DB_USER_PASSWORD"),
-        host="postgres",
-        port="5432",
+logger = logging.getLogger(__name__)
+
+# Listing tools never return more rows than this, whatever limit the model asks for.
+MAX_PAGE_SIZE = int(getenv("TOOL_MAX_PAGE_SIZE", "50"))
+# Columns query_data may filter and sort on; sort columns are NOT NULL so
+# they can take part in keyset comparisons.
+QUERY_TABLES = {
+    "expenses": {
+        "filter": {"id", "amount", "currency", "date", "description", "category_id"},
+        "sort": {"id", "amount", "currency", "date", "category_id"},
+        "default_sort": "date",
+    },
+    "incomes": {
+        "filter": {"id", "amount", "currency", "date", "source"},
+        "sort": {"id", "amount", "currency", "date", "source"},
+        "default_sort": "date",
+    },
+    "budgets": {
+        "filter": {"id", "month", "year", "amount", "currency", "category_id"},
+        "sort": {"id", "month", "year", "amount", "currency"},
+        "default_sort": "id",
+    },
+    "categories": {
+        "filter": {"id", "name", "description"},
+        "sort": {"id", "name"},
+        "default_sort": "id",
+    },
+}
+
+
+def encode_cursor(sort_column, descending, row):
+    value = row[sort_column]
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([sort_column, descending, value, row["id"]], default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor, sort_column, descending):
+    try:
+        column, direction, value, last_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode())
+        )
+    except (ValueError, TypeError):
+        raise ValueError("cursor is not a next_cursor returned by this tool")
+    if column != sort_column or direction != descending:
+        raise ValueError("cursor was returned for a different sort_by")
+    return value, last_id
+
+
+def fetch_page(
+    conn, name, query, params, alias, sort_column, descending, cursor, limit
+):
+    # An explicit sort_by keeps the ascending order the tools always had;
+    # without one the newest rows come first.
+    page_size = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+    sort_key = f"{alias}.{sort_column}"
+    id_key = f"{alias}.id"
+    after, order = ("<", "DESC") if descending else (">", "ASC")
+    if cursor is not None:
+        value, last_id = decode_cursor(cursor, sort_column, descending)
+        if sort_column == "id":
+            query += f" AND {id_key} {after} %s"
+            params.append(last_id)
+        else:
+            query += f" AND ({sort_key}, {id_key}) {after} (%s, %s)"
+            params += [value, last_id]
+    if sort_column == "id":
+        query += f" ORDER BY {id_key} {order}"
+    else:
+        query += f" ORDER BY {sort_key} {order}, {id_key} {order}"
+    query += " LIMIT %s"
+    params.append(page_size + 1)
+
+    # A named cursor keeps the result set on the server; only one page plus
+    # the look-ahead row is ever pulled into memory.
+    with conn.cursor(name=name, cursor_factory=RealDictCursor) as db_cursor:
+        db_cursor.itersize = page_size + 1
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchmany(page_size + 1)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(sort_column, descending, rows[-1])
+    return {"rows": rows, "next_cursor": next_cursor}
+
+
+def bump_data_version(cursor, user_id):
+    # Cached answers are keyed on this version, so any write invalidates them.
+    cursor.execute(
+        "UPDATE users SET data_version = data_version + 1 WHERE id = %s", (user_id,)
     )
 
 
 def list_categories(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = """
-        SELECT c.id, c.name, c.description, c.user_id
-        FROM categories c
-        WHERE c.user_id = %s
-    """
-    cursor.execute(query, (user_id,))
-    categories = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    print(categories, flush=True)
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+            SELECT c.id, c.name, c.description, c.user_id
+            FROM categories c
+            WHERE c.user_id = %s
+        """
+        cursor.execute(query, (user_id,))
+        categories = cursor.fetchall()
+        cursor.close()
+    logger.debug("categories for %s: %s", user_id, categories)
     return categories
 
 
 def add_category(user_id, name, description=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        INSERT INTO categories (name, description, user_id)
-        VALUES (%s, %s, %s)
-        RETURNING id
-    """
-    cursor.execute(query, (name, description, user_id))
-    new_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            INSERT INTO categories (name, description, user_id)
+            VALUES (%s, %s, %s)
+            RETURNING id
+        """
+        cursor.execute(query, (name, description, user_id))
+        new_id = cursor.fetchone()[0]
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return new_id
 
 
 def update_category(user_id, id, name=None, description=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        UPDATE categories
-        SET name = COALESCE(%s, name),
-            description = COALESCE(%s, description)
-        WHERE id = %s AND user_id = %s
-        RETURNING id
-    """
-    cursor.execute(query, (name, description, id, user_id))
-    updated = cursor.rowcount > 0
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            UPDATE categories
+            SET name = COALESCE(%s, name),
+                description = COALESCE(%s, description)
+            WHERE id = %s AND user_id = %s
+            RETURNING id
+        """
+        cursor.execute(query, (name, description, id, user_id))
+        updated = cursor.rowcount > 0
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return updated
 
 
 def delete_category(user_id, id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        DELETE FROM categories
-        WHERE id = %s AND user_id = %s
-        AND NOT EXISTS (
-            SELECT 1 FROM expenses WHERE category_id = categories.id
-            UNION
-            SELECT 1 FROM budgets WHERE category_id = categories.id
-        )
-        RETURNING id
-    """
-    cursor.execute(query, (id, user_id))
-    deleted = cursor.rowcount > 0
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            DELETE FROM categories
+            WHERE id = %s AND user_id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM expenses WHERE category_id = categories.id
+                UNION
+                SELECT 1 FROM budgets WHERE category_id = categories.id
+            )
+            RETURNING id
+        """
+        cursor.execute(query, (id, user_id))
+        deleted = cursor.rowcount > 0
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return deleted
 
 
 def add_expense(user_id, amount, currency, date, category_id, description=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        INSERT INTO expenses (amount, currency, date, description, user_id, category_id)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """
-    cursor.execute(query, (amount, currency, date, description, user_id, category_id))
-    new_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            INSERT INTO expenses (amount, currency, date, description, user_id, category_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """
+        cursor.execute(
+            query, (amount, currency, date, description, user_id, category_id)
+        )
+        new_id = cursor.fetchone()[0]
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return new_id
 
 
@@ -402,9 +492,8 @@ def get_expenses(
     description=None,
     sort_by=None,
     limit=None,
+    cursor=None,
 ):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
     query = """
         SELECT e.id, e.amount, e.currency, e.date, e.description, e.category_id, e.user_id
         FROM expenses e
@@ -426,16 +515,19 @@ def get_expenses(
     if description is not None:
         query += " AND e.description ILIKE %s"
         params.append(f"%{description}%")
-    if sort_by in ["amount", "date"]:
-        query += f" ORDER BY e.{sort_by}"
-    if limit is not None:
-        query += " LIMIT %s"
-        params.append(limit)
-    cursor.execute(query, params)
-    expenses = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return expenses
+    sort_column = sort_by if sort_by in ["amount", "date"] else "date"
+    with connection() as conn:
+        return fetch_page(
+            conn,
+            "get_expenses",
+            query,
+            params,
+            "e",
+            sort_column,
+            sort_column != sort_by,
+            cursor,
+            limit,
+        )
 
 
 def update_expense(
@@ -447,44 +539,155 @@ def update_expense(
     category_id=None,
     description=None,
 ):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        UPDATE expenses
-        SET amount = COALESCE(%s, amount),
-            currency = COALESCE(%s, currency),
-            date = COALESCE(%s, date),
-            category_id = COALESCE(%s, category_id),
-            description = COALESCE(%s, description)
-        WHERE id = %s AND user_id = %s
-        RETURNING id
-    """
-    cursor.execute(
-        query, (amount, currency, date, category_id, description, id, user_id)
-    )
-    updated = cursor.rowcount > 0
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            UPDATE expenses
+            SET amount = COALESCE(%s, amount),
+                currency = COALESCE(%s, currency),
+                date = COALESCE(%s, date),
+                category_id = COALESCE(%s, category_id),
+                description = COALESCE(%s, description)
+            WHERE id = %s AND user_id = %s
+            RETURNING id
+        """
+        cursor.execute(
+            query, (amount, currency, date, category_id, description, id, user_id)
+        )
+        updated = cursor.rowcount > 0
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return updated
 
 
 def delete_expense(user_id, id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        DELETE FROM expenses
-        WHERE id = %s AND user_id = %s
-        RETURNING id
-    """
-    cursor.execute(query, (id, user_id))
-    deleted = cursor.rowcount > 0
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            DELETE FROM expenses
+            WHERE id = %s AND user_id = %s
+            RETURNING id
+        """
+        cursor.execute(query, (id, user_id))
+        deleted = cursor.rowcount > 0
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return deleted
 
 
+# Must match the zone rollup_month() buckets rows in (migration 0003).
+ROLLUP_TZ = pytz.timezone("Europe/Kyiv")
+SUMMARY_GROUP_COLUMNS = {"category": "category_id", "currency": "currency"}
+
+
+def parse_timestamptz(value):
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    if value.tzinfo is None:
+        value = ROLLUP_TZ.localize(value)
+    return value.astimezone(ROLLUP_TZ)
+
+
+def month_start(value, months_ahead=0):
+    month_index = value.year * 12 + value.month - 1 + months_ahead
+    return ROLLUP_TZ.localize(datetime(month_index // 12, month_index % 12 + 1, 1))
+
+
+def rollup_wall_clock(value):
+    # The prompt makes the model write +03:00 all year, so in winter
+    # "2026-01-01 00:00:00+03:00" is 23:00 on Dec 31 in Kyiv and January
+    # would never be whole; its wall clock is what the user meant.
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    return ROLLUP_TZ.localize(value.replace(tzinfo=None))
+
+
+def rollup_range(start_date, end_date):
+    # Summaries read both bounds this way whether they use the rollups or
+    # the raw rows, so the two paths agree. Unparsable values are left for
+    # Postgres to reject.
+    try:
+        return rollup_wall_clock(start_date), rollup_wall_clock(end_date)
+    except ValueError:
+        return start_date, end_date
+
+
+def whole_months(start_date, end_date):
+    try:
+        start = rollup_wall_clock(start_date)
+        end = rollup_wall_clock(end_date)
+    except ValueError:
+        return None
+
+    first = None
+    if start is not None:
+        first = month_start(start)
+        if first != start:
+            first = month_start(start, 1)
+    last = None
+    if end is not None:
+        # The model closes a month as "...-31 23:59:59", so a whole-second
+        # end covers the rest of that second.
+        last = month_start(end + timedelta(seconds=1 if end.microsecond == 0 else 0))
+    if first is not None and last is not None and first >= last:
+        return None
+    return start, end, first, last
+
+
+def summarize_from_rollups(table, rollup_table, user_id, filters, group_column, months):
+    start, end, first, last = months
+    group_select = f"{group_column}, " if group_column else ""
+    filter_sql = "".join(f" AND {column} = %s" for column in filters)
+
+    rollup_query = f"""
+        SELECT {group_select}total_amount, count
+        FROM {rollup_table}
+        WHERE user_id = %s{filter_sql}
+    """
+    params = [user_id, *filters.values()]
+    if first is not None:
+        rollup_query += " AND month >= %s"
+        params.append(first.date())
+    if last is not None:
+        rollup_query += " AND month < %s"
+        params.append(last.date())
+    parts = [rollup_query]
+
+    # Partial months at either edge still come from the raw rows.
+    raw_query = f"""
+        SELECT {group_select}amount AS total_amount, 1 AS count
+        FROM {table}
+        WHERE user_id = %s{filter_sql}
+    """
+    if start is not None and start < first:
+        parts.append(raw_query + " AND date >= %s AND date < %s")
+        params += [user_id, *filters.values(), start, first]
+    if end is not None and end >= last:
+        parts.append(raw_query + " AND date >= %s AND date <= %s")
+        params += [user_id, *filters.values(), last, end]
+
+    query = f"""
+        SELECT {group_select}SUM(total_amount)::bigint as total_amount,
+               COALESCE(SUM(count), 0)::bigint as count
+        FROM ({" UNION ALL ".join(parts)}) parts
+    """
+    if group_column:
+        query += f" GROUP BY {group_column}"
+
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(query, params)
+        summary = cursor.fetchall()
+        cursor.close()
+    return summary
+
+
 def summarize_expenses(
     user_id,
     category_id=None,
@@ -493,53 +696,71 @@ def summarize_expenses(
     end_date=None,
     group_by=None,
 ):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = """
-        SELECT 
-    """
-    if group_by in ["category", "date", "currency"]:
-        query += f"e.{group_by}, "
-    query += """
-        SUM(e.amount) as total_amount, COUNT(e.id) as count
-        FROM expenses e
-        WHERE e.user_id = %s
-    """
-    params = [user_id]
-    if category_id is not None:
-        query += " AND e.category_id = %s"
-        params.append(category_id)
-    if currency is not None:
-        query += " AND e.currency = %s"
-        params.append(currency)
-    if start_date is not None:
-        query += " AND e.date >= %s"
-        params.append(start_date)
-    if end_date is not None:
-        query += " AND e.date <= %s"
-        params.append(end_date)
-    if group_by in ["category", "date", "currency"]:
-        query += f" GROUP BY e.{group_by}"
-    cursor.execute(query, params)
-    summary = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    start_date, end_date = rollup_range(start_date, end_date)
+    if group_by != "date":
+        months = whole_months(start_date, end_date)
+        if months is not None:
+            filters = {"category_id": category_id, "currency": currency}
+            return summarize_from_rollups(
+                "expenses",
+                "expense_rollups",
+                user_id,
+                {
+                    column: value
+                    for column, value in filters.items()
+                    if value is not None
+                },
+                SUMMARY_GROUP_COLUMNS.get(group_by),
+                months,
+            )
+
+    group_column = {**SUMMARY_GROUP_COLUMNS, "date": "date"}.get(group_by)
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+            SELECT 
+        """
+        if group_column:
+            query += f"e.{group_column}, "
+        query += """
+            SUM(e.amount) as total_amount, COUNT(e.id) as count
+            FROM expenses e
+            WHERE e.user_id = %s
+        """
+        params = [user_id]
+        if category_id is not None:
+            query += " AND e.category_id = %s"
+            params.append(category_id)
+        if currency is not None:
+            query += " AND e.currency = %s"
+            params.append(currency)
+        if start_date is not None:
+            query += " AND e.date >= %s"
+            params.append(start_date)
+        if end_date is not None:
+            query += " AND e.date <= %s"
+            params.append(end_date)
+        if group_column:
+            query += f" GROUP BY e.{group_column}"
+        cursor.execute(query, params)
+        summary = cursor.fetchall()
+        cursor.close()
     return summary
 
 
 def add_income(user_id, amount, currency, date, source=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        INSERT INTO incomes (amount, currency, date, source, user_id)
-        VALUES (%s, %s, %s, %s, %s)
-        RETURNING id
-    """
-    cursor.execute(query, (amount, currency, date, source, user_id))
-    new_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            INSERT INTO incomes (amount, currency, date, source, user_id)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id
+        """
+        cursor.execute(query, (amount, currency, date, source, user_id))
+        new_id = cursor.fetchone()[0]
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return new_id
 
 
@@ -551,9 +772,8 @@ def get_incomes(
     source=None,
     sort_by=None,
     limit=None,
+    cursor=None,
 ):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
     query = """
         SELECT i.id, i.amount, i.currency, i.date, i.source, i.user_id
         FROM incomes i
@@ -572,153 +792,166 @@ def get_incomes(
     if source is not None:
         query += " AND i.source ILIKE %s"
         params.append(f"%{source}%")
-    if sort_by in ["amount", "date"]:
-        query += f" ORDER BY i.{sort_by}"
-    if limit is not None:
-        query += " LIMIT %s"
-        params.append(limit)
-    cursor.execute(query, params)
-    incomes = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return incomes
+    sort_column = sort_by if sort_by in ["amount", "date"] else "date"
+    with connection() as conn:
+        return fetch_page(
+            conn,
+            "get_incomes",
+            query,
+            params,
+            "i",
+            sort_column,
+            sort_column != sort_by,
+            cursor,
+            limit,
+        )
 
 
 def summarize_incomes(
     user_id, currency=None, start_date=None, end_date=None, group_by=None
 ):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = """
-        SELECT 
-    """
-    if group_by in ["source", "date", "currency"]:
-        query += f"i.{group_by}, "
-    query += """
-        SUM(i.amount) as total_amount, COUNT(i.id) as count
-        FROM incomes i
-        WHERE i.user_id = %s
-    """
-    params = [user_id]
-    if currency is not None:
-        query += " AND i.currency = %s"
-        params.append(currency)
-    if start_date is not None:
-        query += " AND i.date >= %s"
-        params.append(start_date)
-    if end_date is not None:
-        query += " AND i.date <= %s"
-        params.append(end_date)
-    if group_by in ["source", "date", "currency"]:
-        query += f" GROUP BY i.{group_by}"
-    cursor.execute(query, params)
-    summary = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    start_date, end_date = rollup_range(start_date, end_date)
+    if group_by in [None, "currency"]:
+        months = whole_months(start_date, end_date)
+        if months is not None:
+            return summarize_from_rollups(
+                "incomes",
+                "income_rollups",
+                user_id,
+                {"currency": currency} if currency is not None else {},
+                group_by,
+                months,
+            )
+
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+            SELECT 
+        """
+        if group_by in ["source", "date", "currency"]:
+            query += f"i.{group_by}, "
+        query += """
+            SUM(i.amount) as total_amount, COUNT(i.id) as count
+            FROM incomes i
+            WHERE i.user_id = %s
+        """
+        params = [user_id]
+        if currency is not None:
+            query += " AND i.currency = %s"
+            params.append(currency)
+        if start_date is not None:
+            query += " AND i.date >= %s"
+            params.append(start_date)
+        if end_date is not None:
+            query += " AND i.date <= %s"
+            params.append(end_date)
+        if group_by in ["source", "date", "currency"]:
+            query += f" GROUP BY i.{group_by}"
+        cursor.execute(query, params)
+        summary = cursor.fetchall()
+        cursor.close()
     return summary
 
 
 def add_budget(user_id, amount, currency, month, year, category_id=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        INSERT INTO budgets (amount, currency, month, year, user_id, category_id)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """
-    cursor.execute(query, (amount, currency, month, year, user_id, category_id))
-    new_id = cursor.fetchone()[0]
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            INSERT INTO budgets (amount, currency, month, year, user_id, category_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """
+        cursor.execute(query, (amount, currency, month, year, user_id, category_id))
+        new_id = cursor.fetchone()[0]
+        bump_data_version(cursor, user_id)
+        conn.commit()
+        cursor.close()
     return new_id
 
 
 def get_budgets(user_id, currency=None, category_id=None, month=None, year=None):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = """
-        SELECT b.id, b.amount, b.currency, b.month, b.year, b.user_id, b.category_id
-        FROM budgets b
-        WHERE b.user_id = %s
-    """
-    params = [user_id]
-    if currency is not None:
-        query += " AND b.currency = %s"
-        params.append(currency)
-    if category_id is not None:
-        query += " AND b.category_id = %s"
-        params.append(category_id)
-    if month is not None:
-        query += " AND b.month = %s"
-        params.append(month)
-    if year is not None:
-        query += " AND b.year = %s"
-        params.append(year)
-    cursor.execute(query, params)
-    budgets = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+            SELECT b.id, b.amount, b.currency, b.month, b.year, b.user_id, b.category_id
+            FROM budgets b
+            WHERE b.user_id = %s
+        """
+        params = [user_id]
+        if currency is not None:
+            query += " AND b.currency = %s"
+            params.append(currency)
+        if category_id is not None:
+            query += " AND b.category_id = %s"
+            params.append(category_id)
+        if month is not None:
+            query += " AND b.month = %s"
+            params.append(month)
+        if year is not None:
+            query += " AND b.year = %s"
+            params.append(year)
+        cursor.execute(query, params)
+        budgets = cursor.fetchall()
+        cursor.close()
     return budgets
 
 
 def check_budget(user_id, category_id=None, currency=None, month=None, year=None):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = """
-        SELECT b.amount as budget_amount,
-               COALESCE(SUM(e.amount), 0) as spent_amount
-        FROM budgets b
-        LEFT JOIN expenses e ON b.category_id = e.category_id
-            AND e.date >= %s AND e.date < %s
-            AND e.currency = b.currency
-        WHERE b.user_id = %s
-    """
-    params = [
-        f"{year}-{month}-01",
-        f"{year}-{month + 1}-01" if month < 12 else f"{year + 1}-01-01",
-        user_id,
-    ]
-    if category_id is not None:
-        query += " AND b.category_id = %s"
-        params.append(category_id)
-    if currency is not None:
-        query += " AND b.currency = %s"
-        params.append(currency)
-    if month is not None:
-        query += " AND b.month = %s"
-        params.append(month)
-    if year is not None:
-        query += " AND b.year = %s"
-        params.append(year)
-    query += " GROUP BY b.id, b.amount"
-    cursor.execute(query, params)
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # Budgets are per whole month, so spending always comes from the rollup.
+        # A budget without a category covers all spending in its currency.
+        query = """
+            SELECT b.amount as budget_amount,
+                   COALESCE(SUM(r.total_amount), 0) as spent_amount,
+                   b.currency, b.month, b.year, c.name as category
+            FROM budgets b
+            LEFT JOIN categories c ON c.id = b.category_id
+            LEFT JOIN expense_rollups r ON r.user_id = b.user_id
+                AND (b.category_id IS NULL OR r.category_id = b.category_id)
+                AND r.currency = b.currency
+                AND r.month = make_date(b.year, b.month, 1)
+            WHERE b.user_id = %s
+        """
+        params = [user_id]
+        if category_id is not None:
+            query += " AND b.category_id = %s"
+            params.append(category_id)
+        if currency is not None:
+            query += " AND b.currency = %s"
+            params.append(currency)
+        if month is not None:
+            query += " AND b.month = %s"
+            params.append(month)
+        if year is not None:
+            query += " AND b.year = %s"
+            params.append(year)
+        query += " GROUP BY b.id, b.amount, c.name"
+        cursor.execute(query, params)
+        result = cursor.fetchall()
+        cursor.close()
     return result
 
 
 def get_financial_advice(user_id, context=None):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = """
-        SELECT SUM(e.amount) as total_expenses,
-               SUM(i.amount) as total_income
-        FROM expenses e
-        FULL OUTER JOIN incomes i ON e.user_id = i.user_id
-        WHERE e.user_id = %s OR i.user_id = %s
-        AND e.date >= %s AND e.date <= %s
-        AND i.date >= %s AND i.date <= %s
-    """
-    start_date = (datetime.now().replace(day=1) - timedelta(days=30)).isoformat()
-    end_date = datetime.now().isoformat()
-    cursor.execute(
-        query, (user_id, user_id, start_date, end_date, start_date, end_date)
-    )
-    financials = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        query = """
+            SELECT SUM(e.amount) as total_expenses,
+                   SUM(i.amount) as total_income
+            FROM expenses e
+            FULL OUTER JOIN incomes i ON e.user_id = i.user_id
+            WHERE e.user_id = %s OR i.user_id = %s
+            AND e.date >= %s AND e.date <= %s
+            AND i.date >= %s AND i.date <= %s
+        """
+        start_date = (datetime.now().replace(day=1) - timedelta(days=30)).isoformat()
+        end_date = datetime.now().isoformat()
+        cursor.execute(
+            query, (user_id, user_id, start_date, end_date, start_date, end_date)
+        )
+        financials = cursor.fetchone()
+        cursor.close()
     advice = (
         "Consider reviewing your spending if expenses exceed income."
         if financials["total_expenses"] > financials["total_income"]
@@ -727,27 +960,48 @@ def get_financial_advice(user_id, context=None):
     return {"advice": attributes, "context": context}
 
 
-def query_data(user_id, table, filters=None, sort_by=None, limit=None):
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    query = f"SELECT * FROM {table} WHERE user_id = %s"
+def query_data(user_id, table, filters=None, sort_by=None, limit=None, cursor=None):
+    if table not in QUERY_TABLES:
+        raise ValueError(f"Unknown table '{table}'")
+    columns = QUERY_TABLES[table]
+    query = f"SELECT * FROM {table} t WHERE t.user_id = %s"
     params = [user_id]
     if filters:
         for key, value in filters.items():
-            query += f" AND {key} = %s"
+            if key not in columns["filter"]:
+                raise ValueError(f"Cannot filter {table} by '{key}'")
+            query += f" AND t.{key} = %s"
             params.append(value)
-    if sort_by:
-        query += f" ORDER BY {sort_by}"
-    if limit:
-        query += " LIMIT %s"
-        params.append(limit)
-    cursor.execute(query, params)
-    result = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return result
+    if sort_by is not None and sort_by not in columns["sort"]:
+        raise ValueError(f"Cannot sort {table} by '{sort_by}'")
+    sort_column = sort_by or columns["default_sort"]
+    with connection() as conn:
+        return fetch_page(
+            conn,
+            "query_data",
+            query,
+            params,
+            "t",
+            sort_column,
+            sort_column != sort_by,
+            cursor,
+            limit,
+        )
 
 
+# Tools that never write, so calls from one model turn can run concurrently.
+READ_ONLY_TOOLS = {
+    "list_categories",
+    "get_expenses",
+    "summarize_expenses",
+    "get_incomes",
+    "summarize_incomes",
+    "get_budgets",
+    "check_budget",
+    "get_financial_advice",
+    "query_data",
+}
+
 FUNCTIONS_DICT = {
     "list_categories": list_categories,
     "add_category": add_category,
@@ -782,7 +1036,7 @@ def run_tool(user_id, function_name, args):
 
         result = func(user_id, **args_dict)
 
-        print(result, flush=True)
+        logger.debug("%s result: %s", function_name, result)
         return result
     except TypeError as e:
         raise ValueError(f"Invalid arguments for function '{function_name}': {str(e)}")
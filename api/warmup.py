@@ -0,0 +1,99 @@
+import inspect
+import logging
+import threading
+from contextlib import ExitStack
+from os import getenv
+from time import monotonic, perf_counter, sleep
+
+import chains
+import db
+import jobs
+import logwriter
+import psycopg2
+from tools import FUNCTIONS_DICT, TOOLS
+
+# Seconds to keep retrying Postgres before the worker gives up booting.
+WARMUP_TIMEOUT = float(getenv("WARMUP_TIMEOUT", "60"))
+# When the model stack is loaded: "startup" before /health passes,
+# "background" in a thread while the api already serves, "lazy" on the
+# first prompt that needs it.
+LLM_WARMUP = getenv("LLM_WARMUP", "background")
+
+logger = logging.getLogger(__name__)
+
+# Set once the process can answer prompts; GET /health reports 503 until
+# then and again while the process shuts down.
+ready = threading.Event()
+
+
+def check_tools():
+    for tool in TOOLS:
+        function = tool["function"]
+        name = function["name"]
+        if name not in FUNCTIONS_DICT:
+            raise RuntimeError(f"tool {name} has no function in FUNCTIONS_DICT")
+        accepted = inspect.signature(FUNCTIONS_DICT[name]).parameters
+        properties = function["parameters"].get("properties", {})
+        for arg in properties:
+            if arg not in accepted:
+                raise RuntimeError(f"tool {name} does not accept argument {arg}")
+        for arg in function["parameters"].get("required", []):
+            if arg not in properties:
+                raise RuntimeError(f"tool {name} requires undeclared argument {arg}")
+
+
+def open_connections():
+    # Hold DB_POOL_MIN connections at once so each of them is opened and
+    # answers before the first request needs it.
+    with ExitStack() as stack:
+        for _ in range(db.DB_POOL_MIN):
+            conn = stack.enter_context(db.connection())
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+
+def warmup():
+    started = perf_counter()
+    check_tools()
+    deadline = monotonic() + WARMUP_TIMEOUT
+    while True:
+        try:
+            open_connections()
+            break
+        except psycopg2.Error as e:
+            if monotonic() >= deadline:
+                raise
+            logger.warning("database not ready: %s", e)
+            db.close_pool()
+            sleep(1)
+    # Queued jobs are picked up without waiting for a first request.
+    jobs.ensure_workers()
+    if LLM_WARMUP == "startup":
+        load_llm()
+    elif LLM_WARMUP == "background":
+        threading.Thread(target=load_llm, name="llm-warmup", daemon=True).start()
+    ready.set()
+    logger.info("warmed up in %.2fs", perf_counter() - started)
+
+
+def load_llm():
+    # Builds the prompts and the model client with the tools bound.
+    started = perf_counter()
+    try:
+        chains.get_tool_chain()
+        chains.get_final_chain()
+    except Exception:
+        if LLM_WARMUP == "startup":
+            raise
+        logger.exception("loading the model stack failed")
+        return
+    logger.info("model stack loaded in %.2fs", perf_counter() - started)
+
+
+def shutdown():
+    # In-flight requests are already drained by the server; finish the
+    # jobs being answered and flush execution_log before the pool closes.
+    ready.clear()
+    jobs.stop()
+    logwriter.stop()
+    db.close_pool()
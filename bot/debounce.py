@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from os import getenv
+
+from aiogram.types import Message
+
+# Messages of a chat that arrive within this many seconds of each other are
+# answered as one prompt, e.g. "купив продукти", "500", "вчора". Every
+# answer waits at least this long, so it is off (0) unless configured.
+DEBOUNCE_WINDOW = float(getenv("DEBOUNCE_WINDOW", "0"))
+# A chat that keeps typing is still answered this long after its first message.
+DEBOUNCE_MAX_WAIT = float(getenv("DEBOUNCE_MAX_WAIT", "5"))
+DEBOUNCE_DRAIN_TIMEOUT = float(getenv("DEBOUNCE_DRAIN_TIMEOUT", "30"))
+
+
+class Burst:
+    def __init__(self, loop):
+        self.messages = []
+        self.started = loop.time()
+        self.timer = None
+
+
+class Debouncer:
+    def __init__(self, handle):
+        # handle(message, text) answers the merged prompt; message is the
+        # last one of the burst.
+        self.handle = handle
+        self.bursts = {}
+        # chat_id -> task answering its previous burst, so bursts of a chat
+        # are answered in order.
+        self.running = {}
+
+    def add(self, message: Message) -> None:
+        # Stickers, photos and the like have nothing to add to a prompt.
+        if not message.text:
+            return
+        loop = asyncio.get_running_loop()
+        chat_id = message.chat.id
+        burst = self.bursts.get(chat_id)
+        if burst is None:
+            burst = self.bursts[chat_id] = Burst(loop)
+        else:
+            burst.timer.cancel()
+        burst.messages.append(message)
+        delay = min(DEBOUNCE_WINDOW, burst.started + DEBOUNCE_MAX_WAIT - loop.time())
+        burst.timer = loop.call_later(max(0.0, delay), self.flush, chat_id)
+
+    def flush(self, chat_id) -> None:
+        burst = self.bursts.pop(chat_id, None)
+        if burst is None:
+            return
+        burst.timer.cancel()
+        task = asyncio.create_task(
+            self.answer(self.running.get(chat_id), burst.messages)
+        )
+        self.running[chat_id] = task
+        task.add_done_callback(lambda _: self.forget(chat_id, task))
+
+    def forget(self, chat_id, task) -> None:
+        if self.running.get(chat_id) is task:
+            del self.running[chat_id]
+
+    async def answer(self, previous, messages) -> None:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        text = " ".join(message.text for message in messages if message.text)
+        if not text.strip():
+            return
+        try:
+            await self.handle(messages[-1], text)
+        except Exception:
+            logging.exception("answer to chat %s failed", messages[-1].chat.id)
+
+    async def close(self) -> None:
+        for chat_id in list(self.bursts):
+            self.flush(chat_id)
+        if self.running:
+            _, pending = await asyncio.wait(
+                list(self.running.values()), timeout=DEBOUNCE_DRAIN_TIMEOUT
+            )
+            if pending:
+                logging.warning("stopping with %s unanswered prompts", len(pending))
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+
+# Stands in for api.telegram.org: answers the Bot API methods the bot uses
+# and pushes synthetic updates to a webhook-mode bot. Start the bot with
+# BOT_MODE=webhook and TELEGRAM_API_URL=http://127.0.0.1:8081.
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.next_message_id = 1
+        self.sent = defaultdict(deque)
+        self.latencies = []
+        self.replies = 0
+
+    def message(self, chat_id, text):
+        self.next_message_id += 1
+        return {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": text,
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = dict(await request.post()) if request.can_read_body else {}
+        self.calls[method] += 1
+        if method == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Ponyfin",
+                "username": "ponyfin_bot",
+            }
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(data["chat_id"])
+            if method == "sendMessage" and self.sent[chat_id]:
+                self.latencies.append(
+                    time.perf_counter() - self.sent[chat_id].popleft()
+                )
+                self.replies += 1
+            result = self.message(chat_id, data.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def update(self, update_id, chat_id, text):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {
+                    "id": chat_id,
+                    "is_bot": False,
+                    "first_name": "user",
+                    "username": f"user{chat_id}",
+                },
+                "text": text,
+            },
+        }
+
+
+async def drive(fake, options):
+    rng = random.Random(options.seed)
+    headers = {}
+    if options.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = options.secret
+    statuses = defaultdict(int)
+    limit = asyncio.Semaphore(options.concurrency)
+
+    async def send(session, payload, duplicate):
+        async with limit:
+            if not duplicate:
+                fake.sent[payload["message"]["chat"]["id"]].append(time.perf_counter())
+            async with session.post(
+                options.webhook, json=payload, headers=headers
+            ) as response:
+                statuses[response.status] += 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        tasks = []
+        for update_id in range(1, options.updates + 1):
+            payload = fake.update(
+                update_id, rng.randint(1, options.chats), options.text
+            )
+            tasks.append(asyncio.create_task(send(session, payload, False)))
+            if rng.random() < options.duplicates:
+                # Telegram redelivers an update it thinks was not received.
+                tasks.append(asyncio.create_task(send(session, payload, True)))
+        await asyncio.gather(*tasks)
+        deadline = time.monotonic() + options.timeout
+        while fake.replies < options.updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(fake.latencies)
+    print(f"webhook responses: {dict(statuses)}")
+    print(
+        f"updates: {options.updates}, replies: {fake.replies}, calls: {dict(fake.calls)}"
+    )
+    if latencies:
+        print(
+            f"update to reply: p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f} ms, "
+            f"{len(latencies) / elapsed:.1f} replies/s"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Fake Bot API server and update driver."
+    )
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", help="WEBHOOK_SECRET the bot expects")
+    parser.add_argument("--updates", type=int, default=0, help="0 only serves the API")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument(
+        "--duplicates", type=float, default=0.1, help="share redelivered"
+    )
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--text", default="/start")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    options = parser.parse_args()
+
+    fake = FakeTelegram()
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", fake.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", options.port).start()
+    try:
+        if options.updates:
+            await drive(fake, options)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,20 +2,53 @@ import asyncio
 import logging
 import sys
 from os import getenv
+from time import monotonic
+from urllib.parse import urlencode
 
 import view
+import webhook
 from aiogram import Bot, Dispatcher, html
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message
+from aiogram.utils.chat_action import ChatActionSender
+from aiohttp import web
+from debounce import DEBOUNCE_WINDOW, Debouncer
 from dotenv import load_dotenv
 
 load_dotenv()
 
 TOKEN = getenv("BOT_TOKEN")
+# "polling" runs a single long-poll loop; "webhook" serves updates over HTTP
+# so several replicas can run behind a load balancer.
+BOT_MODE = getenv("BOT_MODE", "polling")
+# Points the bot at another Bot API server, e.g. a local fake for testing.
+TELEGRAM_API_URL = getenv("TELEGRAM_API_URL")
+STREAM_ANSWERS = getenv("STREAM_ANSWERS", "1") == "1"
+# Hand prompts to the api job queue: the handler returns as soon as the job
+# is accepted and a background task delivers the answer.
+PROMPT_JOBS = getenv("PROMPT_JOBS", "0") == "1"
+JOB_RESULT_TIMEOUT = float(getenv("JOB_RESULT_TIMEOUT", "600"))
+# Base address the api can reach the bot on, e.g. http://bot:8080; the api
+# then posts finished jobs to the bot instead of the bot polling for them.
+JOB_CALLBACK_URL = getenv("JOB_CALLBACK_URL")
+JOB_CALLBACK_SECRET = getenv("JOB_CALLBACK_SECRET")
+JOB_CALLBACK_PATH = "/jobs/callback"
+# A job whose callback has not reached this replica by then is checked with
+# the api, which tells whether another replica got it or it failed.
+JOB_CALLBACK_GRACE = float(getenv("JOB_CALLBACK_GRACE", "60"))
+# Telegram allows roughly one edit per second per chat.
+STREAM_EDIT_INTERVAL = float(getenv("STREAM_EDIT_INTERVAL", "1.5"))
 
 dp = Dispatcher()
+# Keeps job tasks referenced until they are done.
+job_tasks = set()
+# job_id -> set when its callback arrives at this replica.
+job_callbacks = {}
 
 
 @dp.message(CommandStart())
@@ -27,7 +60,7 @@ async def command_start(message: Message) -> None:
 
 @dp.message(Command("register"))
 async def command_register(message: Message) -> None:
-    response = view.registrer_user(
+    response = await view.registrer_user(
         telegram_id=message.from_user.id, name=message.from_user.username
     )
     if response.status_code == 201:
@@ -40,22 +73,224 @@ async def command_register(message: Message) -> None:
         await message.answer("Сталася помилка")
 
 
-@dp.message()
-async def echo_handler(message: Message) -> None:
-    response = view.make_prompt(user_id=message.from_user.id, prompt=message.text)
+class StreamedAnswer:
+    def __init__(self, message: Message) -> None:
+        self.message = message
+        self.sent = None
+        self.shown = ""
+        self.last_edit = 0.0
+
+    async def update(self, text: str, final: bool = False) -> None:
+        if final and not text.strip():
+            text = "Не вдалося сформувати відповідь, спробуйте ще раз"
+        if not text.strip() or (text == self.shown and not final):
+            return
+        if not final and monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self.last_edit = monotonic()
+        if not final:
+            # Partial text may end inside an HTML tag, so it is sent plain;
+            # a failed edit is retried with the next chunk.
+            try:
+                await self.send(text, parse_mode=None)
+            except TelegramBadRequest as e:
+                logging.warning(
+                    "stream edit in chat %s failed: %s", self.message.chat.id, e
+                )
+                return
+            self.shown = text
+            return
+        try:
+            await self.send(text)
+        except TelegramBadRequest as e:
+            if "can't parse entities" in e.message:
+                # The model's HTML is broken; show the answer as plain text.
+                await self.send(text, parse_mode=None)
+            else:
+                # The streamed message cannot be edited any more, e.g. it was
+                # deleted; send the answer on its own.
+                logging.warning(
+                    "final edit in chat %s failed: %s", self.message.chat.id, e
+                )
+                self.sent = None
+                await self.send(text, parse_mode=None)
+        self.shown = text
+
+    async def send(self, text: str, **parse_mode) -> None:
+        try:
+            if self.sent is None:
+                self.sent = await self.message.answer(text, **parse_mode)
+            else:
+                await self.sent.edit_text(text, **parse_mode)
+        except TelegramBadRequest as e:
+            # The final text can match the last edit.
+            if "message is not modified" not in e.message:
+                raise
+
+
+async def deliver_job(message: Message, job_id: int, callback: bool = False) -> None:
+    # With callback the api posts the result, so it is only sent from here
+    # once the api gave up on the callback.
+    deadline = monotonic() + JOB_RESULT_TIMEOUT
+    response = view.ApiResponse(504, {})
+    async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
+        while monotonic() < deadline:
+            polled = monotonic()
+            response = await view.wait_job(job_id)
+            if (
+                response.status_code == 200
+                and response.data["status"] in ("done", "failed")
+                and (not callback or response.data.get("callback_status"))
+            ):
+                break
+            if response.status_code not in (200, 502, 504):
+                break
+            if response.status_code != 200 or monotonic() - polled < 1:
+                # The api failed, had no free waiter and answered at once, or
+                # the callback is still being retried.
+                await asyncio.sleep(1)
+    if (
+        callback
+        and response.status_code == 200
+        and response.data.get("callback_status") == "sent"
+    ):
+        return
+    if response.status_code == 200 and response.data["status"] == "done":
+        await message.answer(response.data["answer"])
+    else:
+        await message.answer("Сталася помилка")
+
+
+async def await_callback(message: Message, job_id: int) -> None:
+    arrived = job_callbacks[job_id] = asyncio.Event()
+    try:
+        await asyncio.wait_for(arrived.wait(), JOB_CALLBACK_GRACE)
+    except asyncio.TimeoutError:
+        await deliver_job(message, job_id, callback=True)
+    finally:
+        job_callbacks.pop(job_id, None)
+
+
+def job_callback_url():
+    if not JOB_CALLBACK_URL:
+        return None
+    url = JOB_CALLBACK_URL.rstrip("/") + JOB_CALLBACK_PATH
+    if JOB_CALLBACK_SECRET:
+        url += "?" + urlencode({"secret": JOB_CALLBACK_SECRET})
+    return url
+
+
+async def job_callback(request: web.Request) -> web.Response:
+    if JOB_CALLBACK_SECRET and request.query.get("secret") != JOB_CALLBACK_SECRET:
+        return web.Response(status=401)
+    data = await request.json()
+    if data["job_id"] in job_callbacks:
+        job_callbacks[data["job_id"]].set()
+    bot = request.app["bot"]
+    if data["status"] == "done":
+        await bot.send_message(data["chat_id"], data["answer"])
+    else:
+        await bot.send_message(data["chat_id"], "Сталася помилка")
+    return web.Response()
+
+
+async def submit_job(message: Message, text: str) -> None:
+    response = await view.submit_job(
+        user_id=message.from_user.id,
+        chat_id=message.chat.id,
+        prompt=text,
+        message_id=message.message_id,
+        callback_url=job_callback_url(),
+    )
+    if response.status_code == 401:
+        await message.answer(
+            "Схоже ви ще не зареєстровані. Щоб зареєструватися використайте команду /register"
+        )
+    elif response.status_code == 429:
+        await message.answer(
+            f"Зараз забагато запитів, спробуйте ще раз через {response.data.get('retry_after', 10)} с"
+        )
+    elif response.status_code == 202:
+        if JOB_CALLBACK_URL:
+            # The api posts the answer to job_callback.
+            await message.bot.send_chat_action(message.chat.id, "typing")
+            task = asyncio.create_task(await_callback(message, response.data["job_id"]))
+        else:
+            task = asyncio.create_task(deliver_job(message, response.data["job_id"]))
+        job_tasks.add(task)
+        task.add_done_callback(job_tasks.discard)
+    elif response.status_code != 200:
+        # 200 is a redelivered message whose job is already being answered.
+        await message.answer("Сталася помилка")
+
+
+async def answer_prompt(message: Message, text: str) -> None:
+    if PROMPT_JOBS:
+        await submit_job(message, text)
+        return
+    async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
+        if STREAM_ANSWERS:
+            answer = StreamedAnswer(message)
+            response = await view.stream_prompt(
+                user_id=message.from_user.id,
+                prompt=text,
+                on_text=answer.update,
+                message_id=message.message_id,
+            )
+        else:
+            response = await view.make_prompt(
+                user_id=message.from_user.id,
+                prompt=text,
+                message_id=message.message_id,
+            )
     if response.status_code == 401:
         await message.answer(
             "Схоже ви ще не зареєстровані. Щоб зареєструватися використайте команду /register"
         )
+    elif response.status_code == 429:
+        await message.answer(
+            f"Зараз забагато запитів, спробуйте ще раз через {response.data.get('retry_after', 10)} с"
+        )
+    elif response.status_code == 200 and STREAM_ANSWERS:
+        await answer.update(response.data["answer"], final=True)
     elif response.status_code == 200:
-        await message.answer(response.json()["answer"])
+        await message.answer(response.data["answer"])
     else:
         await message.answer("Сталася помилка")
 
 
+debouncer = Debouncer(answer_prompt)
+
+
+@dp.message()
+async def echo_handler(message: Message) -> None:
+    if DEBOUNCE_WINDOW > 0:
+        debouncer.add(message)
+    else:
+        await answer_prompt(message, message.text)
+
+
 async def main() -> None:
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    await dp.start_polling(bot)
+    session = None
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    bot = Bot(
+        token=TOKEN,
+        session=session,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    # Pending bursts are answered before the api session closes.
+    dp.shutdown.register(debouncer.close)
+    dp.shutdown.register(view.close_session)
+    routes = []
+    if PROMPT_JOBS and JOB_CALLBACK_URL:
+        routes.append((JOB_CALLBACK_PATH, job_callback))
+    if BOT_MODE == "webhook":
+        await webhook.serve(dp, bot, routes)
+    elif routes:
+        await webhook.serve_polling(dp, bot, routes)
+    else:
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,131 @@
-import requests
+import asyncio
+import codecs
+from collections import namedtuple
+from os import getenv
 
+import aiohttp
 
-def registrer_user(telegram_id, name):
-    return requests.post(
-        "http://api:8000/users", json={"telegram_id": telegram_id, "name": name}
+API_URL = getenv("API_URL", "http://api:8000")
+API_TIMEOUT = float(getenv("API_TIMEOUT", "180"))
+API_CONNECT_TIMEOUT = float(getenv("API_CONNECT_TIMEOUT", "5"))
+API_MAX_CONCURRENCY = int(getenv("API_MAX_CONCURRENCY", "200"))
+JOB_POLL_WAIT = float(getenv("JOB_POLL_WAIT", "25"))
+
+ApiResponse = namedtuple("ApiResponse", ["status_code", "data"])
+
+_session = None
+_limit = asyncio.Semaphore(API_MAX_CONCURRENCY)
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            base_url=API_URL,
+            connector=aiohttp.TCPConnector(
+                limit=API_MAX_CONCURRENCY, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=API_TIMEOUT, sock_connect=API_CONNECT_TIMEOUT
+            ),
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def request(method, path, timeout=None, **kwargs):
+    if timeout is not None:
+        kwargs["timeout"] = aiohttp.ClientTimeout(
+            total=timeout, sock_connect=API_CONNECT_TIMEOUT
+        )
+    async with _limit:
+        try:
+            async with get_session().request(method, path, **kwargs) as response:
+                try:
+                    data = await response.json()
+                except (aiohttp.ContentTypeError, ValueError):
+                    data = {}
+                return ApiResponse(response.status, data)
+        except asyncio.TimeoutError:
+            return ApiResponse(504, {})
+        except aiohttp.ClientError:
+            return ApiResponse(502, {})
+
+
+async def post(path, payload, timeout=None):
+    return await request("POST", path, timeout=timeout, json=payload)
+
+
+async def registrer_user(telegram_id, name):
+    return await post("/users", {"telegram_id": telegram_id, "name": name}, timeout=30)
+
+
+async def claim_update(update_id):
+    # 201 for the first replica to receive the update, 409 for any other.
+    return await request("POST", f"/updates/{update_id}", timeout=10)
+
+
+async def release_update(update_id):
+    return await request("DELETE", f"/updates/{update_id}", timeout=10)
+
+
+async def make_prompt(user_id, prompt, message_id=None):
+    return await post(
+        "/prompt", {"user_id": user_id, "prompt": prompt, "message_id": message_id}
     )
 
 
-def make_prompt(user_id, prompt):
-    return requests.post(
-        "http://api:8000/prompt", json={"user_id": user_id, "prompt": prompt}
+async def submit_job(user_id, chat_id, prompt, message_id=None, callback_url=None):
+    return await post(
+        "/jobs",
+        {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "prompt": prompt,
+            "message_id": message_id,
+            "callback_url": callback_url,
+        },
+        timeout=30,
     )
+
+
+async def wait_job(job_id, wait=JOB_POLL_WAIT):
+    # The api holds the request until the job is done or wait runs out.
+    return await request(
+        "GET", f"/jobs/{job_id}", timeout=wait + 30, params={"wait": wait}
+    )
+
+
+async def stream_prompt(user_id, prompt, on_text, message_id=None):
+    payload = {
+        "user_id": user_id,
+        "prompt": prompt,
+        "message_id": message_id,
+        "stream": True,
+    }
+    async with _limit:
+        try:
+            async with get_session().post("/prompt", json=payload) as response:
+                if response.status != 200:
+                    try:
+                        data = await response.json()
+                    except (aiohttp.ContentTypeError, ValueError):
+                        data = {}
+                    return ApiResponse(response.status, data)
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                text = ""
+                async for chunk in response.content.iter_any():
+                    text += decoder.decode(chunk)
+                    await on_text(text)
+                text += decoder.decode(b"", final=True)
+                return ApiResponse(response.status, {"answer": text})
+        except asyncio.TimeoutError:
+            return ApiResponse(504, {})
+        except aiohttp.ClientError:
+            return ApiResponse(502, {})
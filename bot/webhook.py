@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import signal
+from collections import OrderedDict
+from os import getenv
+
+import view
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+# Public URL Telegram should call, e.g. https://bot.example.com; when unset
+# the webhook is expected to be registered already.
+WEBHOOK_URL = getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_SIZE = int(getenv("WEBHOOK_QUEUE_SIZE", "100"))
+WEBHOOK_DEDUPE_SIZE = int(getenv("WEBHOOK_DEDUPE_SIZE", "10000"))
+# Replicas behind a load balancer see each other's redeliveries only through
+# the api's update claims; a single replica can skip that round trip.
+WEBHOOK_SHARED_DEDUPE = getenv("WEBHOOK_SHARED_DEDUPE", "1") == "1"
+WEBHOOK_DRAIN_TIMEOUT = float(getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+
+class RecentIds:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.ids = OrderedDict()
+
+    def __contains__(self, update_id):
+        return update_id in self.ids
+
+    def add(self, update_id):
+        self.ids[update_id] = None
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+    def discard(self, update_id):
+        self.ids.pop(update_id, None)
+
+
+def chat_key(update: Update):
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(
+        getattr(event, "message", None), "chat", None
+    )
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else update.update_id
+
+
+class UpdateWorkers:
+    # Each worker owns a queue and a chat always lands on the same one, so
+    # one chat's messages are handled in order while chats run in parallel.
+    def __init__(self, dp: Dispatcher, bot: Bot):
+        self.dp = dp
+        self.bot = bot
+        self.queues = [
+            asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_WORKERS)
+        ]
+        self.seen = RecentIds(WEBHOOK_DEDUPE_SIZE)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run(queue)) for queue in self.queues]
+
+    async def run(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logging.exception("update %s failed", update.update_id)
+            finally:
+                queue.task_done()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if (
+            WEBHOOK_SECRET
+            and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET
+        ):
+            return web.Response(status=401)
+        update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        update_id = update.update_id
+        if update_id in self.seen:
+            return web.Response()
+        # Marked before the claim so a copy arriving meanwhile is dropped here.
+        self.seen.add(update_id)
+        claimed = False
+        if WEBHOOK_SHARED_DEDUPE:
+            response = await view.claim_update(update_id)
+            if response.status_code == 409:
+                return web.Response()
+            claimed = response.status_code == 201
+            if not claimed:
+                # Answering twice beats dropping the update.
+                logging.warning(
+                    "update %s not claimed: api answered %s",
+                    update_id,
+                    response.status_code,
+                )
+        queue = self.queues[hash(chat_key(update)) % len(self.queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram retries the update later, possibly on another replica.
+            self.seen.discard(update_id)
+            if claimed:
+                await view.release_update(update_id)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def drain(self):
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self.queues)),
+                WEBHOOK_DRAIN_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logging.warning("stopping with unhandled updates")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def make_app(bot: Bot, routes) -> web.Application:
+    app = web.Application()
+    app["bot"] = bot
+    app.router.add_get("/health", lambda request: web.Response(text="ok"))
+    for path, handler in routes:
+        app.router.add_post(path, handler)
+    return app
+
+
+async def start_site(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    return runner, site
+
+
+async def serve(dp: Dispatcher, bot: Bot, routes=()) -> None:
+    workers = UpdateWorkers(dp, bot)
+    app = make_app(bot, routes)
+    app.router.add_post(WEBHOOK_PATH, workers.handle)
+
+    await dp.emit_startup(bot=bot)
+    workers.start()
+    runner, site = await start_site(app)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logging.info(
+        "webhook listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Stop taking updates first, then finish the ones already accepted.
+    await site.stop()
+    await workers.drain()
+    await runner.cleanup()
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+
+
+async def serve_polling(dp: Dispatcher, bot: Bot, routes) -> None:
+    # Long-polls Telegram and serves only routes such as job callbacks.
+    runner, _ = await start_site(make_app(bot, routes))
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()